@@ -0,0 +1,945 @@
+"""Developer commands for the bot in main.py: benchmarks, simulations and an offline load test.
+
+    python dev.py <command> [key=value ...]
+
+Option values are parsed as JSON, e.g. `python dev.py loadtest subreddits=40 latency=0.1`.
+Nothing here is imported by the bot itself.
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import threading
+import mimetypes
+import functools
+import subprocess
+import types
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import main
+from main import (
+    DOWNLOAD_CHUNK_SIZE, ENCODE_PROFILES, TITLE_BATCH_WORKERS, TITLE_STATS, TWEETS_PER_DAY,
+    PostStore, RedditPost, TitleCache, encode_command, make_llm, optimize_title,
+    plan_video_transcode, probe_media, set_client_factory, twitter_violations,
+)
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+class FakeServiceHandler(BaseHTTPRequestHandler):
+    """Base of the local API stand-ins: a fixed latency, injected 503s and request counts."""
+
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real APIs
+    latency = 0.0
+    error_rate = 0.0
+    counts = None
+
+    @classmethod
+    def configure(cls, latency=0.0, error_rate=0.0):
+        cls.latency = latency
+        cls.error_rate = error_rate
+        cls.counts = {'requests': 0, 'errors': 0}
+        cls.lock = threading.Lock()
+
+    def begin(self):
+        """Read the body and wait out the latency; True when the request got an injected 503."""
+        self.body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        time.sleep(self.latency)
+        failed = random.random() < self.error_rate
+        if self.counts is not None:
+            with self.lock:
+                self.counts['requests'] += 1
+                self.counts['errors'] += failed
+        if failed:
+            self.send_json({'errors': [{'message': 'injected failure'}]}, 503)
+        return failed
+
+    def send_json(self, payload, status=200, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class StubChatHandler(FakeServiceHandler):
+    """OpenAI-compatible /chat/completions stand-in that answers after a fixed latency."""
+
+    latency = 0.2
+
+    def do_POST(self):
+        if self.begin():
+            return
+        body = json.loads(self.body)
+        self.send_json({
+            'id': 'stub',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': body['messages'][-1]['content'].lower()},
+                'finish_reason': 'stop'
+            }]
+        })
+
+def start_fake(handler, latency=0.0, error_rate=0.0):
+    """Serve a stand-in on a free local port from a daemon thread; returns (server, base url)."""
+    handler.configure(latency, error_rate)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+def stub_llm(api_base):
+    """The bot's LLM client, pointed at a stand-in."""
+    llm = make_llm()
+    llm.api_base = api_base
+    llm.api_key = 'stub'
+    return llm
+
+def bench_titles(count=40, unique=20, latency=0.2):
+    """Measure title latency and cache hit rate against a local stub LLM backend."""
+    server, url = start_fake(StubChatHandler, latency)
+    previous = set_client_factory('llm', functools.partial(stub_llm, url))
+    os.environ.setdefault('MODEL_NAME', 'stub-model')
+    titles = [f"synthetic post number {i % unique}" for i in range(count)]
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = TitleCache(os.path.join(tmp, 'titles.db'))
+            for label in ('cold', 'warm'):
+                TITLE_STATS.update(hits=0, misses=0, errors=0)
+                latencies = []
+
+                def timed(title):
+                    started = time.perf_counter()
+                    optimize_title(title, cache)
+                    latencies.append(time.perf_counter() - started)
+
+                started = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=TITLE_BATCH_WORKERS) as pool:
+                    list(pool.map(timed, titles))
+                wall = time.perf_counter() - started
+                lookups = TITLE_STATS['hits'] + TITLE_STATS['misses']
+                print(f"{label}: {count} titles in {wall:.2f}s, "
+                      f"p50 {percentile(latencies, 50) * 1000:.1f}ms, "
+                      f"p95 {percentile(latencies, 95) * 1000:.1f}ms, "
+                      f"hit rate {TITLE_STATS['hits'] / lookups:.0%} {TITLE_STATS}")
+            cache.conn.close()
+    finally:
+        # The next get_client('llm') rebuilds the real client from the environment
+        set_client_factory('llm', previous)
+        server.shutdown()
+
+# Synthetic clips for bench-encode: (name, width, height), all needing a re-encode
+BENCH_CLIPS = (
+    ('vertical-1080x1920', 1080, 1920),
+    ('landscape-1920x1080', 1920, 1080),
+    ('vertical-720x1280', 720, 1280),
+    ('square-640', 640, 640),
+)
+
+def bench_encode(duration=8, rate=30, profiles=None):
+    """Encode generated testsrc clips with every profile and report speed, size and compliance."""
+    profiles = profiles or list(ENCODE_PROFILES)
+    results = {name: [] for name in profiles}
+    with tempfile.TemporaryDirectory() as tmp:
+        clips = []
+        for name, width, height in BENCH_CLIPS:
+            # MPEG-4 Part 2 with Opus in Matroska, so every profile has to do a full encode
+            clip = os.path.join(tmp, f"{name}.mkv")
+            subprocess.run([
+                'ffmpeg', '-y', '-v', 'error',
+                '-f', 'lavfi', '-i', f"testsrc=size={width}x{height}:rate={rate}:duration={duration}",
+                '-f', 'lavfi', '-i', f"sine=frequency=440:duration={duration}",
+                '-c:v', 'mpeg4', '-q:v', '3', '-pix_fmt', 'yuv420p', '-c:a', 'libopus', clip
+            ], check=True, capture_output=True)
+            clips.append((name, clip))
+
+        for name, clip in clips:
+            plan = plan_video_transcode(probe_media(clip), os.path.getsize(clip))
+            for profile in profiles:
+                output = os.path.join(tmp, f"{name}.{profile}.mp4")
+                started = time.perf_counter()
+                result = subprocess.run(encode_command(clip, output, plan, profile), capture_output=True, text=True)
+                elapsed = time.perf_counter() - started
+                if result.returncode != 0:
+                    print(f"{profile:>10} {name:<20} failed: {result.stderr.strip().splitlines()[-1:]}")
+                    results[profile].append((elapsed, 0, ['encode failed']))
+                    continue
+                size = os.path.getsize(output)
+                violations = twitter_violations(output)
+                results[profile].append((elapsed, size, violations))
+                print(f"{profile:>10} {name:<20} {plan['duration'] * rate / elapsed:7.1f} fps "
+                      f"{size / (1024 * 1024):6.2f}MB {'ok' if not violations else '; '.join(violations)}")
+                os.remove(output)
+
+    print()
+    summary = []
+    for profile in profiles:
+        elapsed = sum(run[0] for run in results[profile])
+        frames = len(results[profile]) * duration * rate
+        compliant = all(not run[2] for run in results[profile])
+        summary.append((frames / elapsed if elapsed else 0.0, compliant, profile))
+        print(f"{profile:>10}: {frames / elapsed if elapsed else 0.0:7.1f} fps overall, "
+              f"{sum(run[1] for run in results[profile]) / (1024 * 1024):6.2f}MB total, "
+              f"{'all compliant' if compliant else 'NOT compliant'} "
+              f"({ENCODE_PROFILES[profile]})")
+    passing = [entry for entry in summary if entry[1]]
+    if passing:
+        print(f"Fastest compliant profile: {max(passing)[2]} (set ENCODE_PROFILE to use it)")
+    else:
+        print("No profile produced compliant output")
+
+def synthetic_post(post_id, subreddit, created_utc, score):
+    data = {
+        'id': post_id, 'title': f"synthetic {post_id}", 'url': f"https://example.invalid/{post_id}.jpg",
+        'subreddit': subreddit, 'used': False, 'media_path': f"media/{post_id}.jpg",
+        'created_utc': created_utc, 'score': score,
+    }
+    return RedditPost(type('obj', (object,), data), from_json=True)
+
+def pick_random_unused(store):
+    """The selection this engine replaced: a random unused post, for comparison."""
+    with store.lock:
+        bounds = store.conn.execute("SELECT MIN(rowid), MAX(rowid) FROM posts WHERE used = 0").fetchone()
+        if bounds[0] is None:
+            return None
+        row = store.conn.execute(
+            "SELECT * FROM posts WHERE used = 0 AND rowid >= ? ORDER BY rowid LIMIT 1",
+            (random.randint(bounds[0], bounds[1]),)
+        ).fetchone()
+    return store._to_post(row)
+
+def simulate_selection(days=7, publishes_per_day=TWEETS_PER_DAY, ready_share=0.7, seed=7):
+    """Replay a week of synthetic pools through the selection engine and the old random pick.
+
+    Subreddits differ tenfold in volume and in typical score. Every day a
+    top-of-the-week listing is ingested and most posts get prepared, then
+    the day's publishes pick from the pool. Reports publish share per
+    subreddit, age and score of what was picked, the ready share, and pick
+    latency for growing pools.
+    """
+    subreddits = {'huge': 40, 'big': 20, 'medium': 10, 'small': 4}  # posts listed per day
+    activity = {'huge': 8.0, 'big': 6.5, 'medium': 5.5, 'small': 4.0}  # lognormal mean of the score
+    strategies = {'priority': lambda store: store.pick_unused(), 'random': pick_random_unused}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, pick in strategies.items():
+            rng = random.Random(seed)
+            store = PostStore(os.path.join(tmp, f"{label}.db"))
+            start = 1_700_000_000.0
+            picked, latencies = [], []
+            pool_scores = {name: [] for name in subreddits}
+            serial = 0
+            for day in range(days):
+                now = start + day * 86400
+                posts = []
+                for subreddit, volume in subreddits.items():
+                    for _ in range(volume):
+                        serial += 1
+                        created = now - rng.uniform(0, 7 * 86400)
+                        posts.append(synthetic_post(f"{subreddit}{serial}", subreddit, created,
+                                                    int(rng.lognormvariate(activity[subreddit], 1.0))))
+                store.add_posts(posts)
+                for post in posts:
+                    pool_scores[post.subreddit].append(post.score)
+                for post in posts:
+                    if rng.random() < ready_share:
+                        store.mark_ready(post.id, post.media_path)
+                for slot in range(publishes_per_day):
+                    moment = now + (slot + 0.5) * 86400 / publishes_per_day
+                    started = time.perf_counter()
+                    post = pick(store)
+                    latencies.append(time.perf_counter() - started)
+                    if post is None:
+                        break
+                    store.mark_used(post.id)
+                    picked.append((post, moment))
+            store.conn.close()
+
+            total = len(picked)
+            shares = {name: sum(1 for post, _ in picked if post.subreddit == name) / total for name in subreddits}
+            ages = [(moment - post.created_utc) / 3600 for post, moment in picked]
+            # Within the post's own subreddit, since subreddits score on different scales
+            percentiles = [
+                sum(1 for score in pool_scores[post.subreddit] if score <= post.score) / len(pool_scores[post.subreddit])
+                for post, _ in picked
+            ]
+            print(f"{label}: {total} publishes over {days} days")
+            print("  share by subreddit: " + ', '.join(f"{name} {share:.0%}" for name, share in shares.items()))
+            print(f"  age at publish: median {percentile(ages, 50):.1f}h, p90 {percentile(ages, 90):.1f}h")
+            print(f"  score percentile in its subreddit: median {percentile(percentiles, 50):.0%}")
+            print(f"  ready when picked: {sum(1 for post, _ in picked if post.ready_path) / total:.0%}")
+            print(f"  pick latency: p50 {percentile(latencies, 50) * 1000:.2f}ms, p99 {percentile(latencies, 99) * 1000:.2f}ms")
+
+        print("pick latency by pool size:")
+        for size in (1_000, 10_000, 50_000):
+            rng = random.Random(seed)
+            store = PostStore(os.path.join(tmp, f"pool{size}.db"))
+            names = list(subreddits)
+            store.add_posts([
+                synthetic_post(f"p{index}", names[index % len(names)], 1_700_000_000 - rng.uniform(0, 7 * 86400),
+                               int(rng.lognormvariate(6, 1.5)))
+                for index in range(size)
+            ])
+            latencies = []
+            for _ in range(200):
+                started = time.perf_counter()
+                post = store.pick_unused()
+                latencies.append(time.perf_counter() - started)
+                store.mark_used(post.id)
+            store.conn.close()
+            print(f"  {size:>6} posts: p50 {percentile(latencies, 50) * 1000:.2f}ms, p99 {percentile(latencies, 99) * 1000:.2f}ms")
+
+def replay_planned_loop(account, start, end):
+    """Drive plan_publish_slots the way Scheduler._planned_loop does, on a simulated clock; returns the publish times.
+
+    A publish is journaled as selected when its slot fires and the loop
+    re-plans while it is still open, as the real loop does; it is tweeted a
+    minute later. Journal times are stamped with the simulated clock.
+    """
+    store = account.store
+    published, pending = [], None
+    now = last = start
+    while now < end:
+        upcoming = [slot for slot in main.plan_publish_slots(account, now) if slot > last]
+        refresh = now + timedelta(minutes=main.PLAN_REFRESH_MINUTES)
+        slot = min(upcoming) if upcoming else None
+        wake = slot if slot and slot <= refresh else refresh
+        if pending:
+            finish_publish(account, pending, min(now + timedelta(minutes=1), wake))
+            pending = None
+        now = wake
+        if wake == slot:
+            last = slot
+            pending = store.pick_unused()
+            if pending:
+                store.journal_publish(pending.id, 'selected')
+                published.append(slot)
+    if pending:
+        finish_publish(account, pending, now)
+    return published
+
+def finish_publish(account, post, moment):
+    account.store.mark_tweeted(post.id, f"tweet-{post.id}")
+    account.tweet_budget.try_acquire()
+    with account.store.lock, account.store.conn:
+        account.store.conn.execute(
+            "UPDATE publish_journal SET updated_utc = ? WHERE post_id = ?", (moment.timestamp(), post.id)
+        )
+
+def check_planner(posts=40):
+    """Replay a day of the publish planner and fail when a window gets more than its share.
+
+    Each scenario starts from a pool of `posts`: fresh or stale, from just
+    after the ingest or from a restart inside the morning window (with some
+    of its publishes already done). Every window must stay within
+    PUBLISH_BURST with its slots at least a grid step apart.
+    """
+    burst, window = main.PUBLISH_BURST, timedelta(minutes=main.PUBLISH_WINDOW_MINUTES)
+    day = datetime.combine(datetime.now().date(), datetime.min.time())
+    opens = [day + timedelta(hours=9), day + timedelta(hours=17)]
+    step = window / burst
+    grid = [opens[0] + step * i for i in range(burst)]
+    restart = grid[1] + timedelta(minutes=1)
+    late = opens[0] + window / 2 + timedelta(minutes=1)
+    stale_hours = main.STALE_AFTER_HOURS + 24
+    scenarios = [
+        # name, post age in hours, replay start, publishes already done, expected per window
+        ('fresh pool', 1, day + timedelta(seconds=30), [], [burst, burst]),
+        ('stale pool', stale_hours, day + timedelta(seconds=30), [], [1, 1]),
+        ('restart inside a window', 1, restart, grid[:2], [2 + sum(slot >= restart for slot in grid), burst]),
+        ('restart after missed slots', 1, late, [], [sum(slot >= late for slot in grid), burst]),
+    ]
+    failures = []
+    with tempfile.TemporaryDirectory(prefix='check-planner-') as tmp:
+        for index, (name, age, start, done, expected) in enumerate(scenarios):
+            account = main.Account(f"check{index}", ['a', 'b'], posts_db=os.path.join(tmp, f"{index}.db"),
+                                   publish_times=['09:00', '17:00'], tweets_per_day=100)
+            store = account.store
+            created = (day - timedelta(hours=age)).timestamp()
+            store.add_posts([synthetic_post(f"p{index}_{serial}", 'ab'[serial % 2], created, 100 + serial)
+                             for serial in range(posts)])
+            for moment in done:
+                post = store.pick_unused()
+                store.journal_publish(post.id, 'selected')
+                finish_publish(account, post, moment + timedelta(minutes=1))
+            times = list(done) + replay_planned_loop(account, start, day + timedelta(days=1))
+            per_window = [sorted(t for t in times if opens_at <= t < opens_at + window) for opens_at in opens]
+            problems = []
+            if [len(slots) for slots in per_window] != expected:
+                problems.append(f"expected {expected} per window")
+            if any(len(slots) > burst for slots in per_window):
+                problems.append(f"over PUBLISH_BURST ({burst})")
+            gaps = [b - a for slots in per_window for a, b in zip(slots, slots[1:])]
+            if gaps and min(gaps) < step - timedelta(seconds=1):
+                problems.append(f"slots {min(gaps)} apart, under the {step} grid step")
+            counts = ', '.join(f"{opens_at:%H:%M} {len(slots)}" for opens_at, slots in zip(opens, per_window))
+            print(f"{'FAIL' if problems else 'ok  '} {name}: {counts}{'; ' + '; '.join(problems) if problems else ''}")
+            failures += problems
+            store.conn.close()
+    if failures:
+        sys.exit(1)
+    print("OK")
+
+# Modules that must stay off the import path; their clients are built on first use
+LAZY_MODULES = ('praw', 'tweepy', 'openai', 'PIL', 'requests_oauthlib')
+STARTUP_THRESHOLD_MS = float(os.getenv('STARTUP_THRESHOLD_MS', '300'))
+
+def bench_startup(runs=5):
+    """Time `import main` with -X importtime and fail past STARTUP_THRESHOLD_MS or on eager heavy imports."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    timings, modules = [], {}
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', 'import main'],
+            cwd=here, capture_output=True, text=True
+        )
+        if result.returncode != 0:
+            print(result.stderr)
+            sys.exit(1)
+        modules = {}
+        for line in result.stderr.splitlines():
+            match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \|(\s+)(\S+)', line)
+            if match:
+                # cumulative microseconds, and whether main imported it directly (one level in)
+                modules[match.group(4)] = (int(match.group(2)), len(match.group(3)) == 3)
+        timings.append(modules['main'][0] / 1000)
+
+    best = min(timings)
+    print(f"import main: best {best:.1f}ms, median {percentile(timings, 50):.1f}ms over {runs} runs "
+          f"(threshold {STARTUP_THRESHOLD_MS:.0f}ms)")
+    slowest = sorted(((us, name) for name, (us, direct) in modules.items() if direct and name != 'main'), reverse=True)
+    for us, name in slowest[:10]:
+        print(f"  {us / 1000:8.1f}ms  {name}")
+
+    eager = [name for name in LAZY_MODULES if name in modules]
+    if eager:
+        print(f"FAIL: imported at startup: {', '.join(eager)}")
+    if best > STARTUP_THRESHOLD_MS:
+        print(f"FAIL: startup {best:.1f}ms is over the {STARTUP_THRESHOLD_MS:.0f}ms threshold")
+    if eager or best > STARTUP_THRESHOLD_MS:
+        sys.exit(1)
+    print("OK")
+
+class FakeRedditHandler(FakeServiceHandler):
+    """Reddit OAuth API stand-in: the token endpoint and /r/<subreddit>/top listings."""
+
+    listings = {}  # subreddit -> submission data, best first
+    window_started = None
+
+    def do_POST(self):
+        if self.begin():
+            return
+        if not self.path.startswith('/api/v1/access_token'):
+            self.send_json({'error': 404}, 404)
+            return
+        self.send_json({'access_token': 'loadtest', 'token_type': 'bearer', 'expires_in': 86400, 'scope': '*'})
+
+    def do_GET(self):
+        if self.begin():
+            return
+        url = urlparse(self.path)
+        match = re.match(r'/r/([^/]+)/top', url.path)
+        if not match:
+            self.send_json({'error': 404}, 404)
+            return
+        limit = int(parse_qs(url.query).get('limit', ['25'])[0])
+        children = [{'kind': 't3', 'data': data} for data in self.listings.get(match.group(1), [])[:limit]]
+        with self.lock:
+            if self.window_started is None:
+                type(self).window_started = time.time()
+            used = self.counts['requests']
+        # Like Reddit: 1000 requests per 10 minute window, reporting the seconds left in it
+        self.send_json({'kind': 'Listing', 'data': {'after': None, 'before': None, 'children': children}}, headers={
+            'x-ratelimit-used': used,
+            'x-ratelimit-remaining': max(0, 1000 - used),
+            'x-ratelimit-reset': int(600 - (time.time() - self.window_started)),
+        })
+
+class FakeCDNHandler(FakeServiceHandler):
+    """i.redd.it / preview.redd.it / v.redd.it stand-in serving the generated files under `root`."""
+
+    root = None
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        if self.begin():
+            return
+        path = os.path.join(self.root, urlparse(self.path).path.lstrip('/'))
+        if '..' in path or not os.path.isfile(path):
+            self.send_json({'error': 404}, 404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', mimetypes.guess_type(path)[0] or 'application/octet-stream')
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, self.wfile, DOWNLOAD_CHUNK_SIZE)
+
+class FakeXHandler(FakeServiceHandler):
+    """X stand-in: the v1.1 chunked media upload and v2 tweet creation, with rate-limit headers."""
+
+    media = {}  # media_id -> media_category
+    tweets = []
+
+    def limit_headers(self):
+        return {
+            'x-rate-limit-limit': 100000,
+            'x-rate-limit-remaining': 99999,
+            'x-rate-limit-reset': int(time.time()) + 900,
+        }
+
+    def do_GET(self):
+        if self.begin():
+            return
+        # STATUS: processing always finishes by the first poll
+        self.send_json({'processing_info': {'state': 'succeeded', 'progress_percent': 100}}, headers=self.limit_headers())
+
+    def do_POST(self):
+        if self.begin():
+            return
+        if self.path.startswith('/2/tweets'):
+            tweet = json.loads(self.body)
+            with self.lock:
+                self.tweets.append(tweet)
+                tweet_id = str(len(self.tweets))
+            self.send_json({'data': {'id': tweet_id, 'text': tweet['text']}}, 201, headers=self.limit_headers())
+            return
+        if self.headers.get('Content-Type', '').startswith('multipart/'):
+            # APPEND is the only multipart command
+            self.send_response(204)
+            self.send_header('Content-Length', '0')
+            for name, value in self.limit_headers().items():
+                self.send_header(name, str(value))
+            self.end_headers()
+            return
+        form = {key: values[0] for key, values in parse_qs(self.body.decode()).items()}
+        if form.get('command') == 'INIT':
+            with self.lock:
+                media_id = str(1000 + len(self.media))
+                self.media[media_id] = form.get('media_category')
+            self.send_json({'media_id': int(media_id), 'media_id_string': media_id, 'expires_after_secs': 86400},
+                           202, headers=self.limit_headers())
+        elif form.get('command') == 'FINALIZE':
+            result = {'media_id_string': form['media_id'], 'expires_after_secs': 86400}
+            if self.media.get(form['media_id']) == 'tweet_video':
+                result['processing_info'] = {'state': 'pending', 'check_after_secs': 1}
+            self.send_json(result, 201, headers=self.limit_headers())
+        else:
+            self.send_json({'error': 'bad command'}, 400)
+
+# Post kinds in a load test listing and their share
+LOADTEST_MIX = (('image', 0.5), ('gallery', 0.25), ('video', 0.25))
+LOADTEST_STAGES = ('ingest', 'publish', 'reddit_listing', 'media_download', 'hls_download',
+                   'llm_title', 'transcode', 'upload', 'processing_wait', 'tweet')
+
+def loadtest_media(root, kind, post_id, index):
+    """Generate a post's distinct media under root; returns the CDN paths."""
+    if kind == 'video':
+        # A short fragmented MP4 HLS stream; the tone makes every post's content unique
+        directory = os.path.join(root, 'v.redd.it', post_id)
+        os.makedirs(directory)
+        subprocess.run([
+            'ffmpeg', '-y', '-v', 'error',
+            '-f', 'lavfi', '-i', 'testsrc=size=640x360:rate=30:duration=4',
+            '-f', 'lavfi', '-i', f"sine=frequency={220 + index}:duration=4",
+            '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p', '-c:a', 'aac',
+            '-f', 'hls', '-hls_time', '1', '-hls_playlist_type', 'vod', '-hls_segment_type', 'fmp4',
+            '-hls_fmp4_init_filename', 'init.mp4',
+            '-hls_segment_filename', os.path.join(directory, 'seg_%03d.m4s'),
+            os.path.join(directory, 'HLSPlaylist.m3u8')
+        ], check=True, capture_output=True)
+        return [f"v.redd.it/{post_id}/HLSPlaylist.m3u8"]
+
+    from PIL import Image
+    paths = []
+    for item in range(3 if kind == 'gallery' else 1):
+        path = f"preview.redd.it/{post_id}_{item}.jpg" if kind == 'gallery' else f"i.redd.it/{post_id}.jpg"
+        os.makedirs(os.path.dirname(os.path.join(root, path)), exist_ok=True)
+        noise = Image.merge('RGB', [Image.effect_noise((800, 600), 40) for _ in range(3)])
+        noise.save(os.path.join(root, path), 'JPEG', quality=85)
+        paths.append(path)
+    return paths
+
+def loadtest_listings(subreddits, cdn_root, cdn_url, videos):
+    """Five submissions per subreddit, in the shape the Reddit API returns them."""
+    kinds = [kind for kind, _ in LOADTEST_MIX if videos or kind != 'video']
+    weights = [share for kind, share in LOADTEST_MIX if videos or kind != 'video']
+    listings = {}
+    now = time.time()
+    for index in range(subreddits * 5):
+        subreddit = f"loadtest{index // 5}"
+        post_id = f"lt{index:05d}"
+        kind = random.choices(kinds, weights)[0]
+        paths = loadtest_media(cdn_root, kind, post_id, index)
+        data = {
+            'id': post_id, 'name': f"t3_{post_id}", 'title': f"Load Test Post Number {index}",
+            'subreddit': subreddit, 'is_self': False, 'is_video': kind == 'video',
+            'created_utc': now - random.uniform(0, 7 * 86400), 'score': random.randint(10, 50000),
+            'permalink': f"/r/{subreddit}/comments/{post_id}/", 'secure_media': None,
+        }
+        if kind == 'image':
+            data['url'] = f"{cdn_url}/{paths[0]}"
+        elif kind == 'gallery':
+            data['url'] = f"{cdn_url}/gallery/{post_id}"
+            data['gallery_data'] = {'items': [{'media_id': f"m{item}"} for item in range(len(paths))]}
+            data['media_metadata'] = {f"m{item}": {'status': 'valid', 's': {'u': f"{cdn_url}/{path}"}}
+                                      for item, path in enumerate(paths)}
+        else:
+            data['url'] = f"{cdn_url}/v.redd.it/{post_id}"
+            data['secure_media'] = {'reddit_video': {
+                'hls_url': f"{cdn_url}/{paths[0]}",
+                'fallback_url': f"{cdn_url}/v.redd.it/{post_id}/DASH_360.mp4",
+            }}
+        listings.setdefault(subreddit, []).append(data)
+    return listings
+
+def child_env(x_url, **settings):
+    """Environment of a child process running main against the fake X, as the account with the LOADTEST_ prefix."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    return dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join(filter(None, [here, os.environ.get('PYTHONPATH')])),
+        METRICS_PORT='0', TWITTER_UPLOAD_URL=f"{x_url}/1.1/media/upload.json", TWITTER_API_URL=x_url,
+        **{f"LOADTEST_{key}": 'loadtest' for key in (
+            'TWITTER_API_KEY', 'TWITTER_API_SECRET', 'TWITTER_ACCESS_TOKEN', 'TWITTER_ACCESS_TOKEN_SECRET')},
+        **settings
+    )
+
+def loadtest_pipeline(subreddits, publishes):
+    """The measured part of loadtest, run in a child process whose environment points main at the fakes."""
+    account = main.Account('loadtest', [f"loadtest{index}" for index in range(subreddits)], env_prefix='LOADTEST_',
+                           posts_db='loadtest.db', tweets_per_day=max(publishes, 1))
+    started = time.perf_counter()
+    with main.stage('ingest', account=account.name):
+        main.fetch_new_posts(account)
+    ingest_seconds = time.perf_counter() - started
+    stored = account.store.count_unused()
+
+    started = time.perf_counter()
+    for _ in range(publishes):
+        with main.stage('publish', account=account.name):
+            main.post_to_twitter(account)
+    publish_seconds = time.perf_counter() - started
+
+    children = None
+    if main.resource is not None and sys.platform != 'darwin':
+        children = main.resource.getrusage(main.resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    print(json.dumps({'event': 'loadtest', 'stored': stored, 'ingest_s': ingest_seconds,
+                      'publish_s': publish_seconds, 'peak_rss_mb': main.peak_rss_mb(), 'children_rss_mb': children}))
+
+def loadtest(subreddits=20, publishes=20, latency=0.05, error_rate=0.02, videos=True, verbose=False, seed=7):
+    """Run fetch_new_posts and post_to_twitter end to end against local fakes of every API.
+
+    The fakes (Reddit listings, the media CDN, X upload and tweets, and an
+    OpenAI-compatible LLM) answer after `latency` seconds and fail
+    `error_rate` of their requests with a 503. Each subreddit lists five
+    posts. The pipeline runs in a child process in a scratch directory,
+    configured only through its environment, so the bot's media/ and
+    databases are untouched. Reports throughput, p50/p99 per stage and
+    peak memory; the pipeline's own output is shown with verbose=true.
+    """
+    random.seed(seed)
+    if videos and not shutil.which('ffmpeg'):
+        print("FFmpeg not found, running without video posts")
+        videos = False
+
+    servers = []
+    try:
+        with tempfile.TemporaryDirectory(prefix='loadtest-') as workspace:
+            cdn_root = os.path.join(workspace, 'cdn')
+            FakeCDNHandler.root = cdn_root
+            server, cdn_url = start_fake(FakeCDNHandler, latency, error_rate)
+            servers.append(server)
+            started = time.perf_counter()
+            FakeRedditHandler.listings = loadtest_listings(subreddits, cdn_root, cdn_url, videos)
+            print(f"Generated {subreddits * 5} posts' media in {time.perf_counter() - started:.1f}s")
+
+            FakeRedditHandler.window_started = None
+            FakeXHandler.media, FakeXHandler.tweets = {}, []
+            urls = {}
+            for name, handler in (('reddit', FakeRedditHandler), ('x', FakeXHandler), ('llm', StubChatHandler)):
+                server, urls[name] = start_fake(handler, latency, error_rate)
+                servers.append(server)
+
+            env = child_env(
+                urls['x'], POSTS_DB='loadtest.db', ACCOUNTS_FILE='accounts.json',
+                REDDIT_CLIENT_ID='loadtest', REDDIT_CLIENT_SECRET='loadtest',
+                REDDIT_URL=urls['reddit'], REDDIT_OAUTH_URL=urls['reddit'],
+                LLM_API_BASE=urls['llm'], XAI_API_KEY='loadtest',
+                MODEL_NAME=os.environ.get('MODEL_NAME', 'stub-model')
+            )
+            child = subprocess.Popen(
+                [sys.executable, '-c', f"import dev; dev.loadtest_pipeline({subreddits}, {publishes})"],
+                cwd=workspace, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True
+            )
+            samples, result = {}, None
+            for line in child.stdout:
+                try:
+                    event = json.loads(line) if line.startswith('{"event"') else {}
+                except ValueError:
+                    event = {}  # a line another thread's output broke into
+                if event.get('event') == 'stage':
+                    samples.setdefault(event['stage'], []).append(event['duration_s'])
+                elif event.get('event') == 'loadtest':
+                    result = event
+                    continue
+                if verbose:
+                    print(line, end='')
+            child.wait()
+    finally:
+        for server in servers:
+            server.shutdown()
+    if child.returncode != 0 or result is None:
+        print(f"Pipeline failed (exit code {child.returncode}); rerun with verbose=true")
+        sys.exit(1)
+
+    listed = subreddits * 5
+    tweets = len(FakeXHandler.tweets)
+    ingest_seconds, publish_seconds = result['ingest_s'], result['publish_s']
+    print(f"\nIngest: {result['stored']}/{listed} posts stored from {subreddits} subreddits in {ingest_seconds:.2f}s "
+          f"({listed / ingest_seconds:.1f} posts/s)")
+    print(f"Publish: {tweets}/{publishes} tweets in {publish_seconds:.2f}s "
+          f"({tweets / publish_seconds if publish_seconds else 0.0:.2f} tweets/s)")
+    print(f"Latency {latency * 1000:.0f}ms, injected error rate {error_rate:.0%}; requests served:")
+    for name, handler in (('reddit', FakeRedditHandler), ('cdn', FakeCDNHandler),
+                          ('x', FakeXHandler), ('llm', StubChatHandler)):
+        print(f"  {name:<7} {handler.counts['requests']:6} requests, {handler.counts['errors']:4} failed")
+    print(f"{'stage':<16} {'count':>6} {'p50':>10} {'p99':>10}")
+    for name in sorted(samples, key=lambda name: LOADTEST_STAGES.index(name) if name in LOADTEST_STAGES else len(LOADTEST_STAGES)):
+        values = samples[name]
+        print(f"{name:<16} {len(values):6} {percentile(values, 50) * 1000:8.1f}ms {percentile(values, 99) * 1000:8.1f}ms")
+    rss, children = result['peak_rss_mb'], result['children_rss_mb']
+    print(f"Peak RSS: {f'{rss:.0f}MB' if rss is not None else 'n/a'}"
+          f"{f', largest child process {children:.0f}MB' if children else ''}")
+
+def journal_publishes(posts, threads):
+    """The publishes of check_journal, run in a child process whose environment points main at the fake X.
+
+    Journal entries are seeded the way a crash leaves them: selected,
+    uploaded (with media id 777) and tweeting, all with a lease that ran
+    out, plus one whose lease another worker process is still renewing
+    (a deploy overlapping a slot). Three publishes
+    then run one after another and the rest `threads` at a time over
+    `posts` more posts, half of them pre-uploaded.
+    """
+    from PIL import Image
+    account = main.Account('journal', ['a', 'b'], env_prefix='LOADTEST_', posts_db='journal.db', tweets_per_day=1000)
+    store = account.store
+    names = ['selected', 'uploaded', 'tweeting', 'live'] + [f"fresh{index}" for index in range(posts)]
+    batch = []
+    for index, name in enumerate(names):
+        path = f"media/{name}.jpg"
+        Image.effect_noise((64, 64), 40 + index).convert('RGB').save(path, 'JPEG')
+        post = synthetic_post(name, 'ab'[index % 2], time.time() - index, 100)
+        post.media_path, post.media_paths = path, [path]
+        batch.append(post)
+    store.add_posts(batch)
+    for name in names:
+        store.mark_ready(name, f"media/{name}.jpg", f"check {name}")
+    for index in range(0, posts, 2):
+        store.queue_post(f"fresh{index}", [str(900 + index)], time.time() + 86400)
+
+    dead = '1/crashed'
+    store.claim_publish('selected', dead)
+    store.claim_publish('uploaded', dead, ['777'], time.time() + 86400)
+    store.claim_publish('tweeting', dead)
+    store.journal_publish('tweeting', 'tweeting')
+    with store.lock, store.conn:
+        store.conn.execute("UPDATE publish_journal SET claimed_at = ?", (time.time() - main.PUBLISH_LEASE_SECONDS - 1,))
+    store.claim_publish('live', f"{os.getpid() + 1}/other-worker")
+
+    for _ in range(3):
+        main.post_to_twitter(account)
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(lambda _: main.post_to_twitter(account), range(posts + threads)))
+
+    with store.lock:
+        journal = dict(store.conn.execute("SELECT post_id, state FROM publish_journal").fetchall())
+    print(json.dumps({'event': 'journal', 'journal': journal, 'stats': main.PUBLISH_STATS}))
+
+def check_journal(posts=24, threads=8, latency=0.02):
+    """Check the publish journal's crash resume and its claims under concurrent publishes.
+
+    A child process resumes the journal states a crash leaves (see
+    journal_publishes) and then publishes `threads` at a time against the
+    fake X. Fails when a post is tweeted twice, a resumed upload is sent
+    again, a publish cut off mid-tweet is retried, or another worker's
+    live claim is taken over. Exits non-zero when any check fails.
+    """
+    FakeXHandler.media, FakeXHandler.tweets = {}, []
+    server, x_url = start_fake(FakeXHandler, latency)
+    try:
+        with tempfile.TemporaryDirectory(prefix='check-journal-') as workspace:
+            result = subprocess.run(
+                [sys.executable, '-c', f"import dev; dev.journal_publishes({posts}, {threads})"],
+                cwd=workspace, env=child_env(x_url, POSTS_DB='journal.db', ACCOUNTS_FILE='accounts.json'),
+                capture_output=True, text=True
+            )
+    finally:
+        server.shutdown()
+    report = next((json.loads(line) for line in result.stdout.splitlines() if line.startswith('{"event": "journal"')), None)
+    if result.returncode != 0 or report is None:
+        print(result.stdout[-4000:] + result.stderr[-4000:])
+        print(f"Publishes failed (exit code {result.returncode})")
+        sys.exit(1)
+
+    journal = report['journal']
+    tweets = {}
+    for tweet in FakeXHandler.tweets:
+        tweets.setdefault(tweet['text'][len('check '):], []).append(tweet['media']['media_ids'])
+    fresh = [f"fresh{index}" for index in range(posts)]
+    checks = [
+        ('no post tweeted twice', all(len(sent) == 1 for sent in tweets.values()),
+         f"{sum(len(sent) for sent in tweets.values())} tweets of {len(tweets)} posts"),
+        ('every tweet journaled', sorted(tweets) == sorted(name for name, state in journal.items() if state == 'tweeted'), ''),
+        ("'selected' resumed and tweeted", journal.get('selected') == 'tweeted', journal.get('selected')),
+        ("'uploaded' resumed without a new upload", tweets.get('uploaded') == [['777']], tweets.get('uploaded')),
+        ("'tweeting' dropped, not sent again", journal.get('tweeting') == 'dropped' and 'tweeting' not in tweets,
+         journal.get('tweeting')),
+        ("another worker's live claim left alone", journal.get('live') == 'selected' and 'live' not in tweets, journal.get('live')),
+        (f"all {posts} posts published across {threads} threads", all(journal.get(name) == 'tweeted' for name in fresh),
+         f"{sum(journal.get(name) == 'tweeted' for name in fresh)} tweeted"),
+    ]
+    for name, ok, detail in checks:
+        print(f"{'ok  ' if ok else 'FAIL'} {name}{f' ({detail})' if detail and not ok else ''}")
+    print(f"Publish outcomes: {report['stats']}")
+    if not all(ok for _, ok, _ in checks):
+        sys.exit(1)
+    print("OK")
+
+def make_hls_stream(directory, duration=6):
+    """Write a v.redd.it-style fMP4 HLS stream: 720p and 360p variants plus a separate audio rendition."""
+    def run(name, inputs, codec):
+        subprocess.run([
+            'ffmpeg', '-y', '-v', 'error', *inputs, *codec,
+            '-f', 'hls', '-hls_time', '2', '-hls_playlist_type', 'vod', '-hls_segment_type', 'fmp4',
+            '-hls_fmp4_init_filename', f"{name}_init.mp4",
+            '-hls_segment_filename', os.path.join(directory, f"{name}_%03d.m4s"),
+            os.path.join(directory, f"{name}.m3u8")
+        ], check=True, capture_output=True)
+
+    for height in (720, 360):
+        run(f"HLS_{height}", ['-f', 'lavfi', '-i', f"testsrc=size={height * 16 // 9}x{height}:rate=30:duration={duration}"],
+            ['-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p'])
+    run('HLS_AUDIO', ['-f', 'lavfi', '-i', f"sine=frequency=440:duration={duration}"], ['-c:a', 'aac'])
+    with open(os.path.join(directory, 'HLSPlaylist.m3u8'), 'w') as f:
+        f.write('#EXTM3U\n'
+                '#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="audio",NAME="audio",URI="HLS_AUDIO.m3u8"\n'
+                '#EXT-X-STREAM-INF:BANDWIDTH=2500000,RESOLUTION=1280x720,AUDIO="audio"\nHLS_720.m3u8\n'
+                '#EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=640x360,AUDIO="audio"\nHLS_360.m3u8\n')
+    # An encrypted copy of the 360p playlist, which the downloader must refuse
+    with open(os.path.join(directory, 'HLS_360.m3u8')) as f:
+        playlist = f.read()
+    with open(os.path.join(directory, 'Encrypted.m3u8'), 'w') as f:
+        f.write(playlist.replace('#EXTM3U\n', '#EXTM3U\n#EXT-X-KEY:METHOD=AES-128,URI="key.bin"\n', 1))
+
+def check_hls(error_rate=0.1, seed=7):
+    """Check the native HLS downloader and its DASH fallback against a local CDN serving a generated stream.
+
+    Segments fail `error_rate` of the time to exercise the retries. Exits
+    non-zero when any check fails.
+    """
+    if not shutil.which('ffmpeg'):
+        print("FFmpeg not found")
+        sys.exit(1)
+    random.seed(seed)
+    cwd = os.getcwd()
+    failures = []
+
+    def check(name, ok, detail=''):
+        print(f"{'ok  ' if ok else 'FAIL'} {name}{f' ({detail})' if detail else ''}")
+        if not ok:
+            failures.append(name)
+
+    with tempfile.TemporaryDirectory(prefix='check-hls-') as workspace:
+        stream = os.path.join(workspace, 'cdn', 'v.redd.it', 'check')
+        os.makedirs(stream)
+        make_hls_stream(stream)
+        # Progressive DASH files for the fallback
+        subprocess.run(['ffmpeg', '-y', '-v', 'error', '-i', os.path.join(stream, 'HLSPlaylist.m3u8'),
+                        '-map', '0:v:0', '-c', 'copy', os.path.join(stream, 'DASH_720.mp4')], check=True, capture_output=True)
+        subprocess.run(['ffmpeg', '-y', '-v', 'error', '-i', os.path.join(stream, 'HLS_AUDIO.m3u8'),
+                        '-c', 'copy', os.path.join(stream, 'DASH_audio.mp4')], check=True, capture_output=True)
+        FakeCDNHandler.root = os.path.join(workspace, 'cdn')
+        server, cdn_url = start_fake(FakeCDNHandler, 0.0, error_rate)
+        base = f"{cdn_url}/v.redd.it/check"
+        try:
+            # download_media writes under main's relative media/ directory
+            os.chdir(workspace)
+            main.MEDIA_DIR.mkdir(exist_ok=True)
+
+            output = os.path.join(workspace, 'hls.mp4')
+            result = main.download_hls(f"{base}/HLSPlaylist.m3u8", output)
+            probe = main.probe_media(output) if result else None
+            streams = {stream['codec_type']: stream for stream in (probe or {}).get('streams', [])}
+            duration = float((probe or {}).get('format', {}).get('duration') or 0)
+            check('master playlist downloads and remuxes', result == output)
+            check('highest variant chosen', streams.get('video', {}).get('height') == 720,
+                  f"height {streams.get('video', {}).get('height')}")
+            check('audio rendition muxed', 'audio' in streams)
+            check('full duration', abs(duration - 6) < 0.5, f"{duration:.2f}s")
+            check('injected segment failures retried', FakeCDNHandler.counts['errors'] > 0,
+                  f"{FakeCDNHandler.counts['errors']} of {FakeCDNHandler.counts['requests']} requests failed")
+
+            check('encrypted stream refused', main.download_hls(f"{base}/Encrypted.m3u8", output + '.enc') is None)
+            unreachable = 'http://127.0.0.1:9/HLSPlaylist.m3u8'
+            try:
+                check('unreachable playlist returns None', main.download_hls(unreachable, output + '.none') is None)
+            except Exception as e:
+                check('unreachable playlist returns None', False, f"raised {e!r}")
+
+            submission = types.SimpleNamespace(secure_media={'reddit_video': {
+                'hls_url': unreachable, 'fallback_url': f"{base}/DASH_720.mp4"}})
+            path = main.download_media(f"{base}", 'check', submission)
+            probe = main.probe_media(path) if path else None
+            kinds = {stream['codec_type'] for stream in (probe or {}).get('streams', [])}
+            check('dead HLS falls back to DASH with audio', kinds == {'video', 'audio'}, f"streams {sorted(kinds)}")
+        finally:
+            os.chdir(cwd)
+            server.shutdown()
+
+    if failures:
+        print(f"{len(failures)} checks failed")
+        sys.exit(1)
+    print("OK")
+
+COMMANDS = {
+    'bench-titles': bench_titles,
+    'bench-encode': bench_encode,
+    'bench-startup': bench_startup,
+    'check-hls': check_hls,
+    'check-journal': check_journal,
+    'check-planner': check_planner,
+    'simulate-selection': simulate_selection,
+    'loadtest': loadtest,
+}
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in COMMANDS:
+        print(f"usage: python dev.py {{{','.join(COMMANDS)}}} [key=value ...]")
+        sys.exit(2)
+    options = dict(arg.split('=', 1) for arg in sys.argv[2:])
+    COMMANDS[sys.argv[1]](**{key: json.loads(value) for key, value in options.items()})
@@ -1,62 +1,199 @@
 import os
 import json
 import time
-import schedule
-import praw
-import tweepy
 import requests
-import openai
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from pathlib import Path
 from dotenv import load_dotenv
 import random
-from PIL import Image
 import subprocess
-from moviepy.editor import VideoFileClip
 import re
+import sys
+import math
+import mimetypes
+import hashlib
+import sqlite3
+import threading
+import asyncio
+import functools
+import multiprocessing
+import signal
+from datetime import datetime, timedelta
+from contextlib import contextmanager, suppress
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from urllib.parse import urljoin, urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import tempfile
+try:
+    import resource  # peak RSS reporting; not available on Windows
+except ImportError:
+    resource = None
 
 # Load environment variables
 load_dotenv()
 
-# Initialize Reddit API
-reddit = praw.Reddit(
-    client_id=os.getenv('REDDIT_CLIENT_ID'),
-    client_secret=os.getenv('REDDIT_CLIENT_SECRET'),
-    user_agent="RedditTwitterBot/1.0"
-)
-
-# Initialize Twitter API v2 and v1.1
-twitter_client = tweepy.Client(
-    consumer_key=os.getenv('TWITTER_API_KEY'),
-    consumer_secret=os.getenv('TWITTER_API_SECRET'),
-    access_token=os.getenv('TWITTER_ACCESS_TOKEN'),
-    access_token_secret=os.getenv('TWITTER_ACCESS_TOKEN_SECRET')
-)
-
-# Initialize Twitter API v1.1 for media upload
-
-twitter_auth = tweepy.OAuth1UserHandler(
-    os.getenv('TWITTER_API_KEY'),
-    os.getenv('TWITTER_API_SECRET'),
-    os.getenv('TWITTER_ACCESS_TOKEN'),
-    os.getenv('TWITTER_ACCESS_TOKEN_SECRET')
-)
-twitter_api = tweepy.API(twitter_auth, wait_on_rate_limit=True)
+# Shared HTTP client: keep-alive pools, timeouts and jittered backoff on 429/5xx
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', '30'))  # seconds, connect and read
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', '4'))
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '8'))  # open connections per host
 
-try:
-    user = twitter_api.verify_credentials()
-    if user:
-        print(f"Authentication successful. Logged in as {user.screen_name}")
-    else:
-        print("Authentication failed.")
-except Exception as e:
-    print(f"Error during authentication: {e}")
+_http_session = None
+_http_session_lock = threading.Lock()
 
-# Initialize X.ai
-openai.api_key = os.getenv("XAI_API_KEY")
-openai.api_base = "https://api.x.ai/v1"
-    
-# Initialize OpenAI
-# openai.api_key = os.getenv('OPENAI_API_KEY')
+def get_http_session():
+    """Return the process-wide requests.Session used for every Reddit and CDN fetch."""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            retry = Retry(
+                total=HTTP_RETRIES,
+                backoff_factor=0.5,
+                backoff_jitter=0.5,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=frozenset({'GET', 'HEAD'}),
+                respect_retry_after_header=True,
+                raise_on_status=False
+            )
+            # pool_block caps connections per host instead of opening extra throwaway ones
+            adapter = HTTPAdapter(
+                pool_connections=32,
+                pool_maxsize=HTTP_POOL_SIZE,
+                pool_block=True,
+                max_retries=retry
+            )
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _http_session = session
+        return _http_session
+
+def http_get(url, **kwargs):
+    """GET through the shared session with the default timeout."""
+    kwargs.setdefault('timeout', HTTP_TIMEOUT)
+    return get_http_session().get(url, **kwargs)
+
+def http_head(url, **kwargs):
+    """HEAD through the shared session, following redirects."""
+    kwargs.setdefault('timeout', HTTP_TIMEOUT)
+    kwargs.setdefault('allow_redirects', True)
+    return get_http_session().head(url, **kwargs)
+
+def connection_stats():
+    """Count connections opened versus requests that reused a pooled connection."""
+    opened = total_requests = 0
+    adapters = {id(adapter): adapter for adapter in get_http_session().adapters.values()}
+    for adapter in adapters.values():
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                opened += pool.num_connections
+                total_requests += pool.num_requests
+    return {'opened': opened, 'reused': max(total_requests - opened, 0)}
+
+# API clients are built on first use, so importing this module stays cheap and offline.
+# praw, tweepy and openai are imported inside their factories.
+REDDIT_URL = os.getenv('REDDIT_URL', 'https://www.reddit.com')  # token endpoint
+REDDIT_OAUTH_URL = os.getenv('REDDIT_OAUTH_URL', 'https://oauth.reddit.com')
+LLM_API_BASE = os.getenv('LLM_API_BASE', 'https://api.x.ai/v1')
+
+def make_reddit():
+    """Reddit API client on the shared HTTP session."""
+    import praw
+    return praw.Reddit(
+        client_id=os.getenv('REDDIT_CLIENT_ID'),
+        client_secret=os.getenv('REDDIT_CLIENT_SECRET'),
+        user_agent="RedditTwitterBot/1.0",
+        reddit_url=REDDIT_URL,
+        oauth_url=REDDIT_OAUTH_URL,
+        requestor_kwargs={'session': get_http_session()}
+    )
+
+def make_twitter_api():
+    """Twitter API v1.1 client, used for the credential check (tweets go through create_tweet)."""
+    import tweepy
+    twitter_auth = tweepy.OAuth1UserHandler(
+        os.getenv('TWITTER_API_KEY'),
+        os.getenv('TWITTER_API_SECRET'),
+        os.getenv('TWITTER_ACCESS_TOKEN'),
+        os.getenv('TWITTER_ACCESS_TOKEN_SECRET')
+    )
+    # Rate limits are planned by the request budgets instead of sleeping inside tweepy
+    return tweepy.API(twitter_auth, wait_on_rate_limit=False)
+
+def make_llm():
+    """The openai module configured for X.ai."""
+    import openai
+    openai.api_key = os.getenv("XAI_API_KEY")
+    openai.api_base = LLM_API_BASE
+
+    # Initialize OpenAI
+    # openai.api_key = os.getenv('OPENAI_API_KEY')
+    return openai
+
+CLIENT_FACTORIES = {
+    'reddit': make_reddit,
+    'twitter_api': make_twitter_api,
+    'llm': make_llm,
+}
+
+# PRAW is not thread-safe (its rate limiter and token refresh are shared), so each thread gets its own
+PER_THREAD_CLIENTS = {'reddit'}
+
+_clients = {}
+_clients_lock = threading.Lock()
+_thread_clients = threading.local()
+_client_generation = 0  # bumped on injection, so per-thread clients are rebuilt
+
+def get_client(name):
+    """Return the API client `name`, building it on first use.
+
+    Clients in PER_THREAD_CLIENTS are built once per thread, the others
+    once per process.
+    """
+    with _clients_lock:
+        if name in _clients or name not in PER_THREAD_CLIENTS:
+            if name not in _clients:
+                _clients[name] = CLIENT_FACTORIES[name]()
+            return _clients[name]
+        generation = _client_generation
+    built = getattr(_thread_clients, name, None)
+    if built is None or built[0] != generation:
+        built = (generation, CLIENT_FACTORIES[name]())
+        setattr(_thread_clients, name, built)
+    return built[1]
+
+def set_client(name, client):
+    """Inject a client shared by every thread (a fake in tests); None rebuilds it on next use."""
+    global _client_generation
+    with _clients_lock:
+        if client is None:
+            _clients.pop(name, None)
+        else:
+            _clients[name] = client
+        _client_generation += 1
+
+def set_client_factory(name, factory):
+    """Replace how client `name` is built, e.g. against a local stand-in; returns the old factory."""
+    global _client_generation
+    with _clients_lock:
+        previous = CLIENT_FACTORIES[name]
+        CLIENT_FACTORIES[name] = factory
+        _clients.pop(name, None)
+        _client_generation += 1
+    return previous
+
+def verify_credentials():
+    """Check the X credentials once at startup."""
+    try:
+        user = get_client('twitter_api').verify_credentials()
+        if user:
+            print(f"Authentication successful. Logged in as {user.screen_name}")
+        else:
+            print("Authentication failed.")
+    except Exception as e:
+        print(f"Error during authentication: {e}")
 
 # Configuration
 SUBREDDITS = [
@@ -65,10 +202,283 @@ SUBREDDITS = [
 ]
 
 
-POSTS_FILE = 'posts_data.json'
+POSTS_FILE = 'posts_data.json'  # legacy pool, imported into POSTS_DB on first start
+POSTS_DB = os.getenv('POSTS_DB', 'posts_data.db')
 MEDIA_DIR = Path('media')
 MEDIA_DIR.mkdir(exist_ok=True)
 
+# Content-addressed media cache for downloads and transcodes, kept across restarts
+MEDIA_CACHE_DIR = MEDIA_DIR / 'cache'
+MEDIA_CACHE_MB = int(os.getenv('MEDIA_CACHE_MB', '4096'))  # size cap before LRU eviction
+MEDIA_CACHE_VERIFY = os.getenv('MEDIA_CACHE_VERIFY', 'size')  # startup check: 'size' or 'hash'
+MEDIA_CACHE_PIN_MINUTES = int(os.getenv('MEDIA_CACHE_PIN_MINUTES', '60'))  # recent entries are never evicted
+
+# Multi-account mode: one deployment runs a pipeline per entry of ACCOUNTS_FILE
+ACCOUNTS_FILE = os.getenv('ACCOUNTS_FILE', 'accounts.json')
+ACCOUNT_WORKERS = int(os.getenv('ACCOUNT_WORKERS', '0'))  # worker processes, 0 = one per core
+TWEETS_PER_DAY = int(os.getenv('TWEETS_PER_DAY', '17'))  # per-account X write budget
+SHARED_DOWNLOAD_WAIT = int(os.getenv('SHARED_DOWNLOAD_WAIT', '600'))  # seconds a download lock may go untouched
+
+# Ingestion concurrency
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', '8'))  # subreddit listings / media downloads in flight
+PER_HOST_LIMIT = int(os.getenv('PER_HOST_LIMIT', '4'))  # concurrent downloads against a single host
+
+# Downloads stream to disk in chunks and abort once they pass this size
+MAX_DOWNLOAD_MB = int(os.getenv('MAX_DOWNLOAD_MB', '512'))
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+HLS_SEGMENT_WORKERS = int(os.getenv('HLS_SEGMENT_WORKERS', '8'))  # v.redd.it segments fetched at once
+HLS_SEGMENT_RETRIES = int(os.getenv('HLS_SEGMENT_RETRIES', '3'))
+
+_host_semaphores = {}
+_host_semaphores_lock = threading.Lock()
+
+# Preparation stage: transcodes run ahead of publishing on a process pool
+PREPARE_WORKERS = int(os.getenv('PREPARE_WORKERS', '0')) or os.cpu_count() or 1
+PREGENERATE_TITLES = os.getenv('PREGENERATE_TITLES', 'false').lower() == 'true'
+
+# LLM titles: bounded requests, cached per (title, model, prompt version)
+TITLE_PROMPT_VERSION = '1'  # bump when TITLE_PROMPT changes to invalidate cached titles
+TITLE_TIMEOUT = float(os.getenv('TITLE_TIMEOUT', '20'))  # seconds
+TITLE_RETRIES = int(os.getenv('TITLE_RETRIES', '2'))
+TITLE_CACHE_TTL_HOURS = float(os.getenv('TITLE_CACHE_TTL_HOURS', '72'))
+TITLE_CACHE_SIZE = int(os.getenv('TITLE_CACHE_SIZE', '1000'))
+TITLE_BATCH_WORKERS = int(os.getenv('TITLE_BATCH_WORKERS', '4'))
+
+TITLE_STATS = {'hits': 0, 'misses': 0, 'errors': 0}
+_title_stats_lock = threading.Lock()
+
+# X accepts at most this many images on one tweet
+MAX_TWEET_IMAGES = 4
+
+# Chunked media uploads (INIT/APPEND/FINALIZE), resumable across runs
+TWITTER_UPLOAD_URL = os.getenv('TWITTER_UPLOAD_URL', 'https://upload.twitter.com/1.1/media/upload.json')
+UPLOAD_CHUNK_MB = float(os.getenv('UPLOAD_CHUNK_MB', '4'))  # X accepts up to 5MB per APPEND
+UPLOAD_PARALLEL = int(os.getenv('UPLOAD_PARALLEL', '3'))  # APPEND requests in flight
+
+# Scheduler: daily wall-clock slots (local time, HH:MM)
+INGEST_TIMES = ['00:00']
+PUBLISH_TIMES = ['09:00', '17:00']
+PUBLISH_CONCURRENCY = int(os.getenv('PUBLISH_CONCURRENCY', '1'))  # publishes allowed to overlap
+SHUTDOWN_TIMEOUT = int(os.getenv('SHUTDOWN_TIMEOUT', '600'))  # seconds to let in-flight jobs finish
+
+# Adaptive publishing: each publish time opens a window of up to PUBLISH_BURST posts,
+# sized from the fresh posts in the pool and the X write quota left before the next ingest
+PUBLISH_WINDOW_MINUTES = int(os.getenv('PUBLISH_WINDOW_MINUTES', '120'))
+PUBLISH_BURST = int(os.getenv('PUBLISH_BURST', '4'))
+STALE_AFTER_HOURS = float(os.getenv('STALE_AFTER_HOURS', '72'))  # older posts ask for no extra slots
+PREUPLOAD_MINUTES = int(os.getenv('PREUPLOAD_MINUTES', '30'))  # media is uploaded this long before its slot
+PLAN_REFRESH_MINUTES = 15  # planned jobs re-plan at least this often
+MEDIA_ID_MARGIN = 600  # seconds of life an uploaded media id needs left to be tweeted
+PUBLISH_ATTEMPTS = int(os.getenv('PUBLISH_ATTEMPTS', '3'))  # failed publishes of a post before it is dropped
+PUBLISH_LEASE_SECONDS = 120  # a publish claim its holder stops renewing is free to resume after this
+
+# Post selection: subreddits take turns, then the best post wins by score and freshness
+FRESHNESS_HOURS = float(os.getenv('FRESHNESS_HOURS', '24'))  # each this much age offsets an e-fold in score
+READY_BONUS_HOURS = float(os.getenv('READY_BONUS_HOURS', '12'))  # transcoded posts rank as if this much fresher
+
+# Scheduler gauges: lag of the last run per job and the post queue depth
+SCHEDULER_STATS = {'job_lag_seconds': {}, 'queue_depth': {}, 'in_flight': 0, 'planned_slots': {}}
+
+# Cross-run dedup counters (id hits skip all network I/O, media hits are reposts)
+SEEN_STATS = {'id_hits': 0, 'id_misses': 0, 'url_hits': 0, 'media_hits': 0, 'media_misses': 0}
+_seen_stats_lock = threading.Lock()
+# Ingestion media checks: outcomes, and rejections (or fixes) by reason
+MEDIA_CHECK_STATS = {'checked': 0, 'passed': 0, 'fixed': 0, 'rejected': 0}
+MEDIA_CHECK_REASONS = {'fixed': {}, 'rejected': {}}
+_media_check_lock = threading.Lock()
+# Publish journal outcomes: resumed after a restart, retried, dropped, and dropped mid-tweet
+PUBLISH_STATS = {'tweeted': 0, 'resumed': 0, 'retried': 0, 'dropped': 0, 'interrupted': 0}
+_publish_stats_lock = threading.Lock()
+
+# Prometheus-style metrics endpoint on 127.0.0.1 (0 disables it)
+# Request budgets, planned against the quota each API reports in its rate-limit headers
+REDDIT_REQUESTS_PER_MINUTE = int(os.getenv('REDDIT_REQUESTS_PER_MINUTE', '60'))  # OAuth API
+REDDIT_PUBLIC_REQUESTS_PER_MINUTE = int(os.getenv('REDDIT_PUBLIC_REQUESTS_PER_MINUTE', '10'))  # anonymous .json
+X_UPLOAD_REQUESTS_PER_15MIN = int(os.getenv('X_UPLOAD_REQUESTS_PER_15MIN', '415'))  # per account
+LLM_REQUESTS_PER_MINUTE = int(os.getenv('LLM_REQUESTS_PER_MINUTE', '60'))
+BUDGET_WAIT = float(os.getenv('BUDGET_WAIT', '30'))  # longest wait for a request token, seconds
+TWITTER_API_URL = os.getenv('TWITTER_API_URL', 'https://api.twitter.com')
+
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+class Metrics:
+    """Thread-safe counters, gauges and histograms rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.collectors = []
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            buckets, total, count = self.histograms.get(key, ([0] * len(LATENCY_BUCKETS), 0.0, 0))
+            buckets = [n + (value <= bound) for n, bound in zip(buckets, LATENCY_BUCKETS)]
+            self.histograms[key] = (buckets, total + value, count + 1)
+
+    def add_collector(self, collector):
+        """Register a function called before every render to refresh gauges."""
+        self.collectors.append(collector)
+
+    def render(self):
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception as e:
+                print(f"Error collecting metrics: {e}")
+
+        def fmt(name, labels, value):
+            label_text = ','.join(f'{k}="{v}"' for k, v in labels)
+            return f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}"
+
+        lines = []
+        with self.lock:
+            for kind, series in (('counter', self.counters), ('gauge', self.gauges)):
+                typed = set()
+                for (name, labels), value in sorted(series.items()):
+                    if name not in typed:
+                        lines.append(f"# TYPE {name} {kind}")
+                        typed.add(name)
+                    lines.append(fmt(name, labels, value))
+            typed = set()
+            for (name, labels), (buckets, total, count) in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} histogram")
+                    typed.add(name)
+                for bound, n in zip(LATENCY_BUCKETS, buckets):
+                    lines.append(fmt(f"{name}_bucket", labels + (('le', bound),), n))
+                lines.append(fmt(f"{name}_bucket", labels + (('le', '+Inf'),), count))
+                lines.append(fmt(f"{name}_sum", labels, round(total, 6)))
+                lines.append(fmt(f"{name}_count", labels, count))
+        return '\n'.join(lines) + '\n'
+
+METRICS = Metrics()
+
+_stage_capture = threading.local()
+
+def record_stage(name, elapsed, status, transferred=None):
+    """Count one run of a stage in METRICS, or in the list of an open captured_stages() block."""
+    captured = getattr(_stage_capture, 'records', None)
+    if captured is not None:
+        captured.append((name, elapsed, status, transferred))
+        return
+    METRICS.observe('redditbot_stage_duration_seconds', elapsed, stage=name)
+    METRICS.inc('redditbot_stage_total', stage=name, status=status)
+    if transferred:
+        METRICS.inc('redditbot_stage_bytes_total', transferred, stage=name)
+
+@contextmanager
+def captured_stages():
+    """Collect the stages timed in this thread as record_stage() arguments, for a process nobody scrapes."""
+    _stage_capture.records = records = []
+    try:
+        yield records
+    finally:
+        _stage_capture.records = None
+
+@contextmanager
+def stage(name, **fields):
+    """Time a pipeline stage, record it in METRICS and emit a structured log line.
+
+    The body may add fields to the yielded dict; 'bytes' is counted as
+    transferred bytes and 'status' overrides the outcome.
+    """
+    info = dict(fields)
+    started = time.perf_counter()
+    status = 'ok'
+    try:
+        yield info
+    except Exception:
+        status = 'error'
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        status = info.pop('status', status)
+        record_stage(name, elapsed, status, info.get('bytes'))
+        # One write per line, so lines from concurrent stages never interleave
+        print(json.dumps({'event': 'stage', 'stage': name, 'status': status,
+                          'duration_s': round(elapsed, 3), **info}, default=str) + '\n', end='')
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        payload = METRICS.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port=METRICS_PORT):
+    """Serve /metrics on 127.0.0.1 from a daemon thread."""
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+    except OSError as e:
+        print(f"Metrics endpoint disabled, port {port} unavailable: {e}")
+        return None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Metrics available at http://127.0.0.1:{port}/metrics")
+    return server
+
+def collect_runtime_metrics():
+    """Copy the ad-hoc stats dicts into gauges at scrape time."""
+    for key, value in SEEN_STATS.items():
+        METRICS.set('redditbot_dedup', value, result=key)
+    for key, value in MEDIA_CHECK_STATS.items():
+        METRICS.set('redditbot_media_checks', value, result=key)
+    for result, reasons in MEDIA_CHECK_REASONS.items():
+        for reason, value in list(reasons.items()):
+            METRICS.set('redditbot_media_check_reasons', value, result=result, reason=reason)
+    for key, value in TITLE_STATS.items():
+        METRICS.set('redditbot_title_cache', value, result=key)
+    for key, value in PUBLISH_STATS.items():
+        METRICS.set('redditbot_publishes', value, result=key)
+    for key, value in connection_stats().items():
+        METRICS.set('redditbot_http_connections', value, kind=key)
+    for job, lag in SCHEDULER_STATS['job_lag_seconds'].items():
+        METRICS.set('redditbot_job_lag_seconds', lag, job=job)
+    for account, queues in SCHEDULER_STATS['queue_depth'].items():
+        for queue, depth in queues.items():
+            METRICS.set('redditbot_queue_depth', depth, account=account, queue=queue)
+    METRICS.set('redditbot_jobs_in_flight', SCHEDULER_STATS['in_flight'])
+    for job, slots in SCHEDULER_STATS['planned_slots'].items():
+        METRICS.set('redditbot_planned_slots', slots, job=job)
+    for name, bucket in list(API_BUDGETS.items()):
+        METRICS.set('redditbot_api_budget_remaining', bucket.available(), api=name)
+    cache_stats = get_media_cache().stats()
+    for kind, values in cache_stats['kinds'].items():
+        METRICS.set('redditbot_media_cache_lookups', values['hits'], kind=kind, result='hit')
+        METRICS.set('redditbot_media_cache_lookups', values['misses'], kind=kind, result='miss')
+        METRICS.set('redditbot_media_cache_hit_ratio', values['hit_ratio'], kind=kind)
+        METRICS.set('redditbot_media_cache_bytes_saved', values['bytes_saved'], kind=kind)
+    METRICS.set('redditbot_media_cache_bytes', cache_stats['bytes'])
+    METRICS.set('redditbot_media_cache_files', cache_stats['files'])
+
+METRICS.add_collector(collect_runtime_metrics)
+
 class RedditPost:
     def __init__(self, post, from_json=False):
         """Initialize RedditPost with either a PRAW submission object or JSON data."""
@@ -80,6 +490,16 @@ class RedditPost:
             self.used = post.used
             self.media_path = post.media_path
             self.created_utc = post.created_utc
+            # All files of a gallery post, media_path being the first
+            self.media_paths = getattr(post, 'media_paths', None) or ([post.media_path] if post.media_path else [])
+            # Upload-ready file and title from the preparation stage
+            self.ready_path = getattr(post, 'ready_path', None)
+            self.ready_title = getattr(post, 'ready_title', None)
+            self.score = getattr(post, 'score', None) or 0
+            # Media uploaded ahead of the publish slot (see preupload_posts)
+            self.media_ids = getattr(post, 'media_ids', None)
+            self.media_expires = getattr(post, 'media_expires', None)
+            self.submission = None
         else:
             self.id = post.id
             self.title = post.title
@@ -88,16 +508,16 @@ class RedditPost:
             self.used = False
             self.media_path = None
             self.created_utc = post.created_utc
+            self.media_paths = []
+            # The listing's PRAW submission, reused for media info (never stored)
+            self.submission = post
+            self.ready_path = None
+            self.ready_title = None
+            self.score = post.score
+            self.media_ids = None
+            self.media_expires = None
 
-def optimize_title(original_title):
-
-    """Use xAu to optimize the title for Twitter."""
-    try:
-       response = openai.ChatCompletion.create(
-            model=os.getenv("MODEL_NAME"),
-               messages=[
-                {"role": "system", 
-                "content": """Original title: {original_title}
+TITLE_PROMPT = """Original title: {original_title}
 
                     Create a Twitter-optimized version of this title that:
                     1. Is attention-grabbing and engaging
@@ -113,77 +533,445 @@ def optimize_title(original_title):
                     11. Don't use emojis or hashtags
                     12. Do not use the word vibe nor vibes
                     13. Do not write in 1st person, the post should always be 'this guy' 'these dudes' 'this girl' etc.
-                    Respond with only the optimized title."""},
-                {"role": "user", "content": original_title}
-            ]
-        )
+                    Respond with only the optimized title."""
 
-    except Exception as e:
-        print(f"Error optimizing title: {e}")
-        return original_title
+class TitleCache:
+    """Optimized titles in SQLite, keyed on original title, model and prompt version.
+
+    Entries expire after ttl seconds; past max_entries the least recently
+    used ones are evicted.
+    """
+
+    def __init__(self, path=POSTS_DB, ttl=TITLE_CACHE_TTL_HOURS * 3600, max_entries=TITLE_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS title_cache (
+                    key TEXT PRIMARY KEY,
+                    title TEXT,
+                    created REAL,
+                    last_used REAL
+                )""")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS title_cache_last_used ON title_cache(last_used)")
+
+    @staticmethod
+    def make_key(original_title, model):
+        return hashlib.sha256(f"{TITLE_PROMPT_VERSION}\0{model}\0{original_title}".encode()).hexdigest()
+
+    def get(self, key):
+        """Return a fresh cached title or None."""
+        now = time.time()
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT title, created FROM title_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl:
+                self.conn.execute("DELETE FROM title_cache WHERE key = ?", (key,))
+                return None
+            self.conn.execute("UPDATE title_cache SET last_used = ? WHERE key = ?", (now, key))
+            return row[0]
+
+    def put(self, key, title):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO title_cache (key, title, created, last_used) VALUES (?, ?, ?, ?)",
+                (key, title, now, now)
+            )
+            self.conn.execute("""
+                DELETE FROM title_cache WHERE key IN (
+                    SELECT key FROM title_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                )""", (self.max_entries,))
 
+_title_cache = None
+_title_cache_pid = None
+_title_cache_lock = threading.Lock()
+
+# SQLite connections inherited through fork(); kept referenced so the child never uses or closes them
+_inherited_connections = []
+
+def get_title_cache():
+    """Open the title cache once per process (forked workers must not share a connection)."""
+    global _title_cache, _title_cache_pid
+    with _title_cache_lock:
+        if _title_cache is None or _title_cache_pid != os.getpid():
+            if _title_cache is not None:
+                _inherited_connections.append(_title_cache)
+            _title_cache = TitleCache()
+            _title_cache_pid = os.getpid()
+        return _title_cache
+
+def request_title(original_title, model):
+    """Ask the LLM for an optimized title, bounded by TITLE_TIMEOUT."""
+    llm = get_client('llm')
+    budget = get_budget('llm')
+    if not budget.acquire(BUDGET_WAIT):
+        raise llm.error.RateLimitError("LLM request budget exhausted")
+    try:
+        with stage('llm_title', model=model):
+            response = llm.ChatCompletion.create(
+                model=model,
+                messages=[
+                    {"role": "system", "content": TITLE_PROMPT},
+                    {"role": "user", "content": original_title}
+                ],
+                request_timeout=TITLE_TIMEOUT
+            )
+    except llm.error.RateLimitError as e:
+        # The provider is out of quota for now; back off for the rest of the minute
+        retry_after = (getattr(e, 'headers', None) or {}).get('retry-after', 60)
+        budget.sync(0, retry_after)
+        raise
     return response['choices'][0]['message']['content']
 
-def download_media(url, post_id):
-    """Download media from Reddit post."""
+def optimize_title(original_title, cache=None):
+    """Use xAi to optimize the title for Twitter, through the title cache (or `cache`)."""
+    model = os.getenv("MODEL_NAME")
+    cache = cache or get_title_cache()
+    key = TitleCache.make_key(original_title, model)
+
+    cached = cache.get(key)
+    if cached is not None:
+        count_title('hits')
+        return cached
+    count_title('misses')
+
+    for attempt in range(TITLE_RETRIES + 1):
+        try:
+            title = request_title(original_title, model)
+            break
+        except Exception as e:
+            print(f"Error optimizing title (attempt {attempt + 1}/{TITLE_RETRIES + 1}): {e}")
+            if attempt < TITLE_RETRIES:
+                time.sleep(2 ** attempt + random.random())
+    else:
+        count_title('errors')
+        return original_title
+
+    cache.put(key, title)
+    return title
+
+def optimize_titles(original_titles):
+    """Optimize many titles at once with TITLE_BATCH_WORKERS concurrent requests."""
+    unique_titles = list(dict.fromkeys(original_titles))
+    with ThreadPoolExecutor(max_workers=TITLE_BATCH_WORKERS) as pool:
+        optimized = dict(zip(unique_titles, pool.map(optimize_title, unique_titles)))
+    return [optimized[title] for title in original_titles]
+
+def stream_to_file(url, file_path, headers=None, max_bytes=None):
+    """Stream url to file_path in chunks, renaming it into place only on success.
+
+    Returns True when the file was written. Downloads larger than max_bytes
+    (MAX_DOWNLOAD_MB by default) are aborted as soon as that is known.
+    """
+    if max_bytes is None:
+        max_bytes = MAX_DOWNLOAD_MB * 1024 * 1024
+    file_path = str(file_path)
+    part_path = f"{file_path}.part"
+    try:
+        with http_get(url, headers=headers, stream=True) as response:
+            if response.status_code != 200:
+                print(f"Failed to download {url}: {response.status_code}")
+                return False
+
+            content_length = int(response.headers.get('Content-Length') or 0)
+            if content_length > max_bytes:
+                print(f"Skipping {url}: {content_length} bytes exceeds the {max_bytes} byte limit")
+                return False
+
+            written = 0
+            with open(part_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    if not chunk:
+                        continue
+                    written += len(chunk)
+                    if written > max_bytes:
+                        print(f"Aborting {url}: exceeded the {max_bytes} byte limit")
+                        break
+                    f.write(chunk)
+                else:
+                    f.flush()
+                    os.fsync(f.fileno())
+
+        if written == 0 or written > max_bytes:
+            os.remove(part_path)
+            return False
+        os.replace(part_path, file_path)
+        METRICS.inc('redditbot_download_bytes_total', written, host=urlparse(url).hostname or '')
+        return True
+
+    except Exception as e:
+        print(f"Error streaming {url}: {e}")
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        return False
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, or None when unsupported."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def parse_hls_attributes(text):
+    """Parse an HLS attribute list such as BANDWIDTH=800000,CODECS="avc1,mp4a"."""
+    return {key: value.strip('"') for key, value in re.findall(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)', text)}
+
+def parse_hls_playlist(text, base_url):
+    """Parse a master or media playlist into variants, audio renditions and segments.
+
+    Relative URIs are resolved against base_url. Segments are (url, duration)
+    pairs; `init` is the EXT-X-MAP initialization segment of fragmented MP4
+    streams. Encryption and byte ranges are flagged as unsupported.
+    """
+    playlist = {'variants': [], 'audio': {}, 'segments': [], 'init': None, 'unsupported': None}
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    if not lines or lines[0] != '#EXTM3U':
+        playlist['unsupported'] = 'not an HLS playlist'
+        return playlist
+    pending = None
+    for line in lines[1:]:
+        if line.startswith('#EXT-X-STREAM-INF:'):
+            pending = ('variant', parse_hls_attributes(line.split(':', 1)[1]))
+        elif line.startswith('#EXTINF:'):
+            pending = ('segment', float(line.split(':', 1)[1].split(',')[0] or 0))
+        elif line.startswith('#EXT-X-MEDIA:'):
+            attributes = parse_hls_attributes(line.split(':', 1)[1])
+            if attributes.get('TYPE') == 'AUDIO' and attributes.get('URI'):
+                playlist['audio'].setdefault(attributes.get('GROUP-ID'), urljoin(base_url, attributes['URI']))
+        elif line.startswith('#EXT-X-MAP:'):
+            playlist['init'] = urljoin(base_url, parse_hls_attributes(line.split(':', 1)[1])['URI'])
+        elif line.startswith('#EXT-X-KEY:') and 'METHOD=NONE' not in line:
+            playlist['unsupported'] = 'encrypted stream'
+        elif line.startswith('#EXT-X-BYTERANGE'):
+            playlist['unsupported'] = 'byte-range segments'
+        elif not line.startswith('#') and pending:
+            kind, value = pending
+            if kind == 'variant':
+                playlist['variants'].append({
+                    'url': urljoin(base_url, line),
+                    'bandwidth': int(value.get('BANDWIDTH') or 0),
+                    'resolution': value.get('RESOLUTION'),
+                    'audio': value.get('AUDIO'),
+                })
+            else:
+                playlist['segments'].append((urljoin(base_url, line), value))
+            pending = None
+    return playlist
+
+def fetch_hls_playlist(url, headers=None):
+    """Fetch and parse a playlist; None on any failure, so the caller can fall back."""
+    try:
+        response = http_get(url, headers=headers)
+    except requests.RequestException as e:
+        print(f"Failed to fetch HLS playlist {url}: {e}")
+        return None
+    if response.status_code != 200:
+        print(f"Failed to fetch HLS playlist {url}: {response.status_code}")
+        return None
+    return parse_hls_playlist(response.text, response.url or url)
+
+def hls_head(playlist):
+    """Segments up to the Twitter duration limit; the transcode would trim the rest anyway."""
+    segments, covered = [], 0.0
+    for segment_url, duration in playlist['segments']:
+        if covered >= TWITTER_MAX_DURATION:
+            break
+        segments.append(segment_url)
+        covered += duration
+    return segments, covered
+
+def fetch_hls_segment(url, path, headers=None):
+    """Download one segment, retrying with backoff."""
+    for attempt in range(HLS_SEGMENT_RETRIES + 1):
+        if stream_to_file(url, path, headers=headers):
+            return True
+        if attempt < HLS_SEGMENT_RETRIES:
+            time.sleep(0.5 * 2 ** attempt + random.random() * 0.5)
+    return False
+
+def fetch_hls_track(playlist, directory, name, headers=None):
+    """Download a media playlist's segments concurrently and join them into one file.
+
+    MPEG-TS segments, and fragmented MP4 segments behind their init segment,
+    are valid streams when concatenated. Returns the joined path or None.
+    """
+    segments, _ = hls_head(playlist)
+    urls = ([playlist['init']] if playlist['init'] else []) + segments
+    paths = [os.path.join(directory, f"{name}_{index:05d}") for index in range(len(urls))]
+    with ThreadPoolExecutor(max_workers=HLS_SEGMENT_WORKERS) as pool:
+        results = list(pool.map(lambda item: fetch_hls_segment(*item, headers=headers), zip(urls, paths)))
+    if not urls or not all(results):
+        print(f"HLS {name}: {results.count(False)} of {len(urls)} segments failed")
+        return None
+    suffix = '.mp4' if playlist['init'] else '.ts'
+    joined = os.path.join(directory, f"{name}{suffix}")
+    with open(joined, 'wb') as out:
+        for path in paths:
+            with open(path, 'rb') as f:
+                while True:
+                    chunk = f.read(DOWNLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    out.write(chunk)
+            os.remove(path)
+    return joined
+
+def download_hls(master_url, output_path, headers=None):
+    """Download an HLS stream natively and remux it to output_path with stream copy.
+
+    Picks the highest-bandwidth variant whose estimated size (with audio, up
+    to the Twitter duration limit) fits the Twitter size cap, then fetches its
+    segments and the audio rendition's segments HLS_SEGMENT_WORKERS at a time.
+    Returns output_path, or None so the caller can fall back to DASH.
+    """
+    with stage('hls_download', url=master_url) as info:
+        master = fetch_hls_playlist(master_url, headers)
+        if master is None or master['unsupported']:
+            print(f"HLS not usable: {master and master['unsupported']}")
+            info['status'] = 'failed'
+            return None
+        variants = sorted(master['variants'], key=lambda variant: variant['bandwidth'], reverse=True)
+        if not variants:
+            # A media playlist was given directly
+            variants = [{'url': master_url, 'bandwidth': 0, 'resolution': None, 'audio': None}]
+
+        max_bytes = TWITTER_MAX_SIZE_MB * 1024 * 1024
+        chosen = video = None
+        for variant in variants:
+            playlist = master if variant['url'] == master_url else fetch_hls_playlist(variant['url'], headers)
+            if playlist is None or playlist['unsupported'] or not playlist['segments']:
+                continue
+            _, covered = hls_head(playlist)
+            chosen, video = variant, playlist
+            # BANDWIDTH is the peak rate including the audio rendition, so this errs large
+            if variant['bandwidth'] * covered / 8 <= max_bytes:
+                break
+        if video is None:
+            print("HLS has no usable variant")
+            info['status'] = 'failed'
+            return None
+        print(f"HLS variant {chosen['resolution'] or 'default'} at {chosen['bandwidth'] // 1000}kbps "
+              f"({len(video['segments'])} segments)")
+
+        audio = None
+        audio_url = master['audio'].get(chosen['audio']) if chosen['audio'] else None
+        if audio_url:
+            audio = fetch_hls_playlist(audio_url, headers)
+            if audio is not None and (audio['unsupported'] or not audio['segments']):
+                audio = None
+
+        with tempfile.TemporaryDirectory(dir=MEDIA_DIR) as tmp:
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                futures = {'video': pool.submit(fetch_hls_track, video, tmp, 'video', headers)}
+                if audio is not None:
+                    futures['audio'] = pool.submit(fetch_hls_track, audio, tmp, 'audio', headers)
+                tracks = {name: future.result() for name, future in futures.items()}
+            if not tracks['video']:
+                info['status'] = 'failed'
+                return None
+
+            command = ['ffmpeg', '-y', '-v', 'error', '-i', tracks['video']]
+            if tracks.get('audio'):
+                command += ['-i', tracks['audio'], '-map', '0:v:0', '-map', '1:a:0']
+            command += ['-c', 'copy', '-movflags', '+faststart', output_path]
+            try:
+                result = subprocess.run(command, capture_output=True, text=True)
+            except OSError as e:
+                print(f"FFmpeg HLS remux could not run: {e}")
+                info['status'] = 'failed'
+                return None
+            if result.returncode != 0 or not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
+                print(f"FFmpeg HLS remux error: {result.stderr}")
+                info['status'] = 'failed'
+                return None
+        info['bytes'] = os.path.getsize(output_path)
+        return output_path
+
+def download_media(url, post_id, submission=None):
+    """Download media from Reddit post.
+
+    `submission` is the PRAW submission from the listing, when available,
+    so its media info is used without fetching the post again. Returns the
+    file path, a list of up to MAX_TWEET_IMAGES paths for a gallery, or None.
+    """
     try:
         # For images and GIFs
         if url.lower().endswith(('.jpg', '.jpeg', '.png', '.gif')):
-            response = requests.get(url)
-            if response.status_code == 200:
-                extension = url.split('.')[-1].lower()
-                file_path = MEDIA_DIR / f"{post_id}.{extension}"
-                with open(file_path, 'wb') as f:
-                    f.write(response.content)
+            extension = url.split('.')[-1].lower()
+            file_path = MEDIA_DIR / f"{post_id}.{extension}"
+            if stream_to_file(url, file_path):
                 return str(file_path)
             
         if re.search('/gallery/', url):
-        # Transform the URL to the API endpoint
-            permalink = url.replace("gallery", "comments")
-            api_url = f"{permalink}.json"
-
-            # Fetch the gallery metadata
-            headers = {"User-Agent": "YourApp/0.1"}
-            response = requests.get(api_url, headers=headers)
+            # Listing submissions already carry the gallery metadata; vars() avoids a lazy PRAW refetch
+            gallery_data = None
+            if submission is not None and vars(submission).get("media_metadata"):
+                gallery_data = vars(submission)
+            else:
+                # Transform the URL to the API endpoint
+                permalink = url.replace("gallery", "comments")
+                api_url = f"{permalink}.json"
 
-            # Check for a valid response
+                # Fetch the gallery metadata
+                headers = {"User-Agent": "YourApp/0.1"}
+                budget = get_budget('reddit_public')
+                if not budget.acquire(BUDGET_WAIT):
+                    print("Reddit public API budget exhausted, skipping gallery")
+                    return None
+                response = http_get(api_url, headers=headers)
+                # Reddit reports the seconds left in the window, not a timestamp
+                budget.sync(response.headers.get('x-ratelimit-remaining'), response.headers.get('x-ratelimit-reset'))
 
-            if response.status_code == 200:
+                # Check for a valid response
+                if response.status_code != 200:
+                    print(f"Failed to fetch gallery metadata. Status code: {response.status_code}")
+                    return None
                 try:
                     data = response.json()
                     gallery_data = data[0]["data"]["children"][0]["data"]
-
-                    # Extract gallery metadata
-                    media_metadata = gallery_data.get("media_metadata", {})
-                    if not media_metadata:
-                        print("No media metadata found in gallery.")
-                        return None
-
-                    file_paths = []
-                    for key, media in media_metadata.items():
-                        media_url = media["s"]["u"].replace("&amp;", "&")  # Replace HTML entities
-                        extension = media_url.split('.')[-1].split('?')[0].lower()
-                        file_path = MEDIA_DIR / f"{post_id}_{key}.{extension}"
-
-                        # Download each image in the gallery
-                        media_response = requests.get(media_url)
-                        if media_response.status_code == 200:
-                            with open(str(file_path), 'wb') as f:
-                                f.write(media_response.content)
-                            file_paths.append(str(file_path))
-                        else:
-                            print(f"Failed to download media: {media_url}")
-
-                    return file_paths[0]
-                except ValueError as e:
+                except (ValueError, LookupError) as e:
                     print(f"Error parsing JSON: {e}")
                     print("Response content:", response.text)  # Log the raw content for debugging
                     return None
 
-            else:
-                print(f"Failed to fetch gallery metadata. Status code: {response.status_code}")
+            # Extract gallery metadata
+            media_metadata = gallery_data.get("media_metadata") or {}
+            if not media_metadata:
+                print("No media metadata found in gallery.")
                 return None
 
+            # Gallery order comes from gallery_data; only the images a tweet can carry are fetched
+            item_ids = [item["media_id"] for item in (gallery_data.get("gallery_data") or {}).get("items", [])]
+            item_ids = [key for key in item_ids if key in media_metadata] or list(media_metadata)
+            downloads = []
+            for key in item_ids:
+                source = media_metadata[key].get("s", {})
+                if "u" not in source:
+                    continue  # animated items carry no still image
+                media_url = source["u"].replace("&amp;", "&")  # Replace HTML entities
+                extension = media_url.split('.')[-1].split('?')[0].lower()
+                downloads.append((media_url, MEDIA_DIR / f"{post_id}_{key}.{extension}"))
+                if len(downloads) == MAX_TWEET_IMAGES:
+                    break
+
+            # Download the gallery images concurrently
+            with ThreadPoolExecutor(max_workers=MAX_TWEET_IMAGES) as pool:
+                results = list(pool.map(lambda item: stream_to_file(*item), downloads))
+
+            file_paths = []
+            for (media_url, file_path), ok in zip(downloads, results):
+                if ok:
+                    file_paths.append(str(file_path))
+                else:
+                    print(f"Failed to download media: {media_url}")
+
+            return file_paths or None
+
         # For Reddit-hosted videos
         elif 'v.redd.it' in url:
             print(f"Downloading Reddit video from URL: {url}")
@@ -192,12 +980,17 @@ def download_media(url, post_id):
             output_path = str(MEDIA_DIR / f'{post_id}.mp4')
             
             try:
-                # Get the submission using PRAW
-                submission = reddit.submission(id=post_id)
+                # Reuse the listing's submission; only posts from the JSON pool are fetched again
+                if submission is None:
+                    if not acquire_reddit_budget():
+                        print("Reddit API budget exhausted, skipping video")
+                        return None
+                    submission = get_client('reddit').submission(id=post_id)
+                secure_media = vars(submission).get('secure_media') or getattr(submission, 'secure_media', None)
                 
                 # Get the secure media info
-                if hasattr(submission, 'secure_media') and submission.secure_media:
-                    video_data = submission.secure_media['reddit_video']
+                if secure_media and 'reddit_video' in secure_media:
+                    video_data = secure_media['reddit_video']
                     
                     # Try to get HLS URL first
                     hls_url = video_data.get('hls_url')
@@ -207,22 +1000,10 @@ def download_media(url, post_id):
                             'User-Agent': f'python:reddit-to-twitter:v1.0 (by /u/{os.getenv("REDDIT_USERNAME")})'
                         }
                         
-                        # Download using FFmpeg directly from HLS stream
-                        cmd = [
-                            'ffmpeg', '-y',
-                            '-headers', f'User-Agent: {headers["User-Agent"]}',
-                            '-i', hls_url,
-                            '-c', 'copy',
-                            output_path
-                        ]
-                        
-                        result = subprocess.run(cmd, capture_output=True)
-                        if result.returncode == 0:
-                            if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
-                                print(f"Video downloaded successfully using HLS. Size: {os.path.getsize(output_path)} bytes")
-                                return output_path
-                        else:
-                            print(f"FFmpeg HLS error: {result.stderr.decode()}")
+                        # Fetch the segments in parallel and remux them locally
+                        if download_hls(hls_url, output_path, headers=headers):
+                            print(f"Video downloaded successfully using HLS. Size: {os.path.getsize(output_path)} bytes")
+                            return output_path
                     
                     # Fallback to direct download if HLS fails
                     print("Falling back to direct download...")
@@ -234,12 +1015,8 @@ def download_media(url, post_id):
                     
                     # Download video
                     print("Downloading video stream...")
-                    response = requests.get(video_url, headers=headers)
-                    if response.status_code == 200:
-                        with open(temp_video_path, 'wb') as f:
-                            f.write(response.content)
-                    else:
-                        print(f"Failed to download video: {response.status_code}")
+                    if not stream_to_file(video_url, temp_video_path, headers=headers):
+                        print("Failed to download video")
                         return None
                     
                     # Try different audio URL patterns
@@ -257,16 +1034,16 @@ def download_media(url, post_id):
                     
                     print("Trying to download audio stream...")
                     for audio_url in audio_urls:
+                        # Probe with HEAD so missing candidates cost no body transfer
                         print(f"Attempting audio URL: {audio_url}")
-                        response = requests.get(audio_url, headers=headers)
-                        if response.status_code == 200:
+                        probe = http_head(audio_url, headers=headers)
+                        if probe.status_code != 200:
+                            print(f"Failed to get audio from {audio_url}: {probe.status_code}")
+                            continue
+                        if stream_to_file(audio_url, temp_audio_path, headers=headers):
                             print(f"Successfully found audio at: {audio_url}")
-                            with open(temp_audio_path, 'wb') as f:
-                                f.write(response.content)
                             has_audio = True
                             break
-                        else:
-                            print(f"Failed to get audio from {audio_url}: {response.status_code}")
                     
                     # Combine video and audio if both exist
                     if has_audio and os.path.exists(temp_video_path) and os.path.exists(temp_audio_path):
@@ -280,7 +1057,10 @@ def download_media(url, post_id):
                             '-shortest',
                             output_path
                         ]
-                        result = subprocess.run(cmd, capture_output=True)
+                        with stage('audio_merge', post_id=post_id) as info:
+                            result = subprocess.run(cmd, capture_output=True)
+                            if result.returncode != 0:
+                                info['status'] = 'failed'
                         if result.returncode != 0:
                             print(f"FFmpeg error: {result.stderr.decode()}")
                             # If combining fails, just use the video
@@ -319,16 +1099,9 @@ def download_media(url, post_id):
                 headers = {
                     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
                 }
-                response = requests.get(url, headers=headers, stream=True)
-                if response.status_code == 200:
-                    with open(output_path, 'wb') as f:
-                        for chunk in response.iter_content(chunk_size=8192):
-                            if chunk:
-                                f.write(chunk)
-                    
-                    if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
-                        print(f"Video downloaded successfully. Size: {os.path.getsize(output_path)} bytes")
-                        return output_path
+                if stream_to_file(url, output_path, headers=headers):
+                    print(f"Video downloaded successfully. Size: {os.path.getsize(output_path)} bytes")
+                    return output_path
             
             except Exception as e:
                 print(f"Error downloading direct video: {str(e)}")
@@ -338,257 +1111,2178 @@ def download_media(url, post_id):
         print(f"Error in download_media: {str(e)}")
     return None
 
-def load_posts():
-    """Load posts from JSON file."""
-    if os.path.exists(POSTS_FILE):
-        with open(POSTS_FILE, 'r') as f:
-            data = json.load(f)
-            posts = []
-            for post_data in data:
-                post = RedditPost(type('obj', (object,), post_data), from_json=True)
-                posts.append(post)
-            return posts
-    return []
-
-def save_posts(posts):
-    """Save posts to JSON file."""
-    with open(POSTS_FILE, 'w') as f:
-        json.dump([post.__dict__ for post in posts], f)
-
-def fetch_new_posts():
-    """Fetch new posts from Reddit."""
-    posts = []
-    for subreddit_name in SUBREDDITS:
-        try:
-            subreddit = reddit.subreddit(subreddit_name)
-            # Get the top 5 posts for the week from the subreddit
-            for index ,post in enumerate(subreddit.top(limit=5, time_filter = 'week')):
+def post_priority(score, created_utc, ready=False):
+    """Selection priority of a post: log score, plus freshness, plus a bonus when transcoded.
 
-                print('this is post number', index)
+    Decaying a score by exp(-age / FRESHNESS_HOURS) orders posts the same as
+    log(score) + created / FRESHNESS_HOURS, which does not change as time
+    passes, so it can be stored and indexed once.
+    """
+    hours = ((created_utc or 0) / 3600) + (READY_BONUS_HOURS if ready else 0)
+    return math.log1p(max(score or 0, 0)) + hours / FRESHNESS_HOURS
 
-                if not post.is_self and hasattr(post, 'url'):
-                    print(f"\nProcessing post: {post.title[:50]}...")
-                    print(f"URL: {post.url}")
-                    
-                    if subreddit_name.lower() == 'tiktokcringe' and not (post.is_video or 'v.redd.it' in post.url):
-                        print("Skipping non-video post in TikTokCringe")
-                        continue
-                    
-                    reddit_post = RedditPost(post)
-                    media_path = download_media(reddit_post.url, reddit_post.id)
-                    
-                    if media_path:
-                        reddit_post.media_path = media_path
-                        posts.append(reddit_post)
-                        print(f"Successfully added {'video' if media_path.endswith('.mp4') else 'image'} post from r/{subreddit_name}")
-                    else:
-                        print("Failed to download media, skipping post")
-                        
-        except Exception as e:
-            print(f"Error fetching posts from {subreddit_name}: {str(e)}")
-    
-    save_posts(posts)
-    print(f"\nFetched {len(posts)} new posts")
+class PostStore:
+    """Persistent post pool in SQLite, indexed by post id and used state.
 
-def process_video_for_twitter(input_path):
-    """Process video to meet Twitter's requirements."""
-    try:
-        print("Processing video for Twitter compatibility...")
-        # Create a temporary file path
-        temp_path = str(MEDIA_DIR / f"temp_{os.path.basename(input_path)}")
-        output_path = str(MEDIA_DIR / f"processed_{os.path.basename(input_path)}")
+    Posts are only ever inserted or flagged, so the used history survives
+    every daily refresh and doubles as the dedup record.
+    """
 
-        # Load video and get info
-        video = VideoFileClip(input_path)
-        duration = video.duration
-        
-        # Twitter video requirements
-        MAX_DURATION = 140  # seconds
-        MAX_SIZE_MB = 512
-        TARGET_BITRATE = "2M"  # 2 Mbps is a good balance
-        
-        if duration > MAX_DURATION:
-            print(f"Video too long ({duration}s), trimming to {MAX_DURATION}s")
-            video = video.subclip(0, MAX_DURATION)
-        
-        # Close the video to free up resources
-        video.close()
-        
-        # Use ffmpeg to process video with Twitter-compatible settings
-        command = [
-            'ffmpeg', '-y',  # Overwrite output files
-            '-i', input_path,
-            '-c:v', 'libx264',  # Video codec
-            '-c:a', 'aac',      # Audio codec
-            '-b:v', TARGET_BITRATE,  # Video bitrate
-            '-pix_fmt', 'yuv420p',  # Pixel format
-            '-movflags', '+faststart',  # Enable fast start
-            '-strict', 'experimental',
-            output_path
+    # Columns added after the first release, created on open for older databases
+    ADDED_COLUMNS = {'ready_path': 'TEXT', 'ready_title': 'TEXT', 'media_paths': 'TEXT',
+                     'score': 'INTEGER', 'priority': 'REAL',
+                     'media_ids': 'TEXT', 'media_expires': 'REAL', 'queued_at': 'REAL'}
+
+    def __init__(self, path=POSTS_DB):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            # Sync the WAL on every commit, so a journaled publish step survives power loss too
+            self.conn.execute("PRAGMA synchronous=FULL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS posts (
+                    id TEXT PRIMARY KEY,
+                    title TEXT,
+                    url TEXT,
+                    subreddit TEXT,
+                    used INTEGER NOT NULL DEFAULT 0,
+                    media_path TEXT,
+                    created_utc REAL
+                )""")
+            existing = {row['name'] for row in self.conn.execute("PRAGMA table_info(posts)")}
+            for column, column_type in self.ADDED_COLUMNS.items():
+                if column not in existing:
+                    self.conn.execute(f"ALTER TABLE posts ADD COLUMN {column} {column_type}")
+            # Secondary indexes carry the rowid, so this orders unused posts by (used, rowid)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS posts_used ON posts(used)")
+            # Selection reads the best unused post of a subreddit straight off this index
+            self.conn.execute("CREATE INDEX IF NOT EXISTS posts_pick ON posts(used, subreddit, priority)")
+            rows = self.conn.execute(
+                "SELECT id, score, created_utc, ready_path FROM posts WHERE priority IS NULL"
+            ).fetchall()
+            self.conn.executemany("UPDATE posts SET priority = ? WHERE id = ?", [
+                (post_priority(row['score'], row['created_utc'], row['ready_path'] is not None), row['id'])
+                for row in rows
+            ])
+            # Round-robin order of subreddits: the lowest turn publishes next
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS subreddit_turns (
+                    subreddit TEXT PRIMARY KEY,
+                    turn INTEGER NOT NULL DEFAULT 0
+                )""")
+            self.conn.execute("INSERT OR IGNORE INTO subreddit_turns (subreddit) SELECT DISTINCT subreddit FROM posts")
+            # Every Reddit id ever downloaded, with its media url and content hash
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS seen (
+                    id TEXT PRIMARY KEY,
+                    url TEXT,
+                    media_hash TEXT,
+                    seen_utc REAL
+                )""")
+            # Chunked upload sessions, so an interrupted upload resumes at the next unacked chunk
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS upload_sessions (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER,
+                    mtime REAL,
+                    media_id TEXT,
+                    expires REAL,
+                    acked TEXT
+                )""")
+            # Write-ahead journal of publishes: selected -> uploaded -> tweeting -> tweeted (or dropped);
+            # claimed_by names the running publish that holds an open entry, renewing claimed_at as it goes
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS publish_journal (
+                    post_id TEXT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    media_ids TEXT,
+                    media_expires REAL,
+                    tweet_id TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    updated_utc REAL,
+                    claimed_by TEXT,
+                    claimed_at REAL
+                )""")
+            journal_columns = {row['name'] for row in self.conn.execute("PRAGMA table_info(publish_journal)")}
+            for column, column_type in (('claimed_by', 'TEXT'), ('claimed_at', 'REAL')):
+                if column not in journal_columns:
+                    self.conn.execute(f"ALTER TABLE publish_journal ADD COLUMN {column} {column_type}")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS seen_url ON seen(url)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS seen_media_hash ON seen(media_hash)")
+
+    def _to_post(self, row):
+        data = dict(row, used=bool(row['used']))
+        data['media_paths'] = json.loads(data['media_paths']) if data.get('media_paths') else None
+        data['media_ids'] = json.loads(data['media_ids']) if data.get('media_ids') else None
+        return RedditPost(type('obj', (object,), data), from_json=True)
+
+    def add_posts(self, posts):
+        """Insert new posts; known posts keep their used state."""
+        with self.lock, self.conn:
+            self._insert_posts(posts)
+
+    def _insert_posts(self, posts):
+        rows = [
+            (p.id, p.title, p.url, p.subreddit, int(p.used), p.media_path, json.dumps(p.media_paths), p.created_utc,
+             p.score, post_priority(p.score, p.created_utc, p.ready_path is not None))
+            for p in posts
         ]
-        
-        print("Running ffmpeg command...")
-        result = subprocess.run(command, capture_output=True, text=True)
-        
-        if result.returncode != 0:
-            print(f"FFmpeg error: {result.stderr}")
-            return None
-            
-        # Check final file size
-        size_mb = os.path.getsize(output_path) / (1024 * 1024)
-        if size_mb > MAX_SIZE_MB:
-            print(f"Processed video too large ({size_mb}MB), trying with lower bitrate...")
-            # Try again with lower bitrate
-            command[8] = "1M"  # Lower bitrate
-            subprocess.run(command, capture_output=True, text=True)
-            
-        if os.path.exists(output_path):
-            print(f"Video processed successfully: {output_path}")
-            return output_path
-            
-    except Exception as e:
-        print(f"Error processing video: {str(e)}")
-    return None
+        # A still-unused post that was downloaded again gets its fresh media paths
+        self.conn.executemany("""
+            INSERT INTO posts (id, title, url, subreddit, used, media_path, media_paths, created_utc, score, priority)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET media_path = excluded.media_path, media_paths = excluded.media_paths
+            WHERE posts.used = 0""", rows)
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO subreddit_turns (subreddit) VALUES (?)",
+            [(subreddit,) for subreddit in {p.subreddit for p in posts}]
+        )
 
-def post_to_twitter():
-    """Post an unused post to Twitter."""
-    posts = load_posts()
-    unused_posts = [post for post in posts if not post.used]
-    
-    if not unused_posts:
-        print("No unused posts available")
-        return
-    
-    post = random.choice(unused_posts)
-    try:
-        # Optimize the title
-        optimized_title = optimize_title(post.title)
-        
-        # Check if media file still exists
-        if not os.path.exists(post.media_path):
-            print(f"Media file not found: {post.media_path}")
-            post.used = True
-            save_posts(posts)
-            return
-        
-        print(f"Posting to Twitter: {optimized_title}")
-        
-        try:
-            upload_path = post.media_path
-            is_video = post.media_path.endswith('.mp4')
-            
-            # Process video if necessary
-            if is_video:
-                print("Processing video before upload...")
-                processed_path = process_video_for_twitter(post.media_path)
-                if processed_path:
-                    upload_path = processed_path
-                else:
-                    print("Video processing failed")
-                    post.used = True
-                    save_posts(posts)
-                    return
-            
-            # Upload media using v1.1 API
-            print(f"Uploading media file: {upload_path}")
-            media_category = 'tweet_video' if is_video else 'tweet_image'
+    def pick_unused(self):
+        """Pick the next post to publish, or None.
 
-            if not os.path.exists(upload_path):
-                print("File does not exist!")
-            else:
-                print(f"File size: {os.path.getsize(upload_path)} bytes")
-                try:
-                    img = Image.open(upload_path)
-                    print(f"Image format: {img.format}")
-                except Exception as e:
-                    print(f"Error reading image: {e}")
+        Subreddits take turns, the one picked longest ago first, and within
+        a subreddit the unused post with the highest post_priority wins. Each
+        probe is one descent of the posts_pick index, so a pick costs
+        O(subreddits * log n) however large the pool grows.
+        """
+        with self.lock, self.conn:
+            turns = self.conn.execute("SELECT subreddit FROM subreddit_turns ORDER BY turn, subreddit").fetchall()
+            for (subreddit,) in turns:
+                row = self.conn.execute("""
+                    SELECT * FROM posts WHERE used = 0 AND subreddit = ? AND queued_at IS NULL
+                        AND id NOT IN (SELECT post_id FROM publish_journal WHERE state IN ('selected', 'uploaded', 'tweeting'))
+                    ORDER BY priority DESC LIMIT 1""", (subreddit,)
+                ).fetchone()
+                if row is not None:
+                    self.conn.execute(
+                        "UPDATE subreddit_turns SET turn = (SELECT MAX(turn) FROM subreddit_turns) + 1 WHERE subreddit = ?",
+                        (subreddit,)
+                    )
+                    return self._to_post(row)
+        return None
 
-            
-            # Ensure that the app's permissions include "Read and Write" 
-            media = twitter_api.media_upload(
-                filename=upload_path,
-                media_category=media_category
+    def queue_post(self, post_id, media_ids, expires):
+        """Record media uploaded ahead of time; queued posts publish first, in queue order."""
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE posts SET media_ids = ?, media_expires = ?, queued_at = ? WHERE id = ?",
+                (json.dumps(media_ids), expires, time.time(), post_id)
             )
-            print(f"Media uploaded with ID: {media.media_id_string}")
-            
-            # Wait for video processing if it's a video
-            if is_video:
-                print("Waiting for video processing...")
-                media_status = twitter_api.get_media_upload_status(media.media_id)
-                while media_status.processing_info and media_status.processing_info['state'] == 'pending':
-                    wait_time = media_status.processing_info.get('check_after_secs', 5)
-                    print(f"Video still processing, waiting {wait_time} seconds...")
-                    time.sleep(wait_time)
-                    media_status = twitter_api.get_media_upload_status(media.media_id)
-                
-                if media_status.processing_info and media_status.processing_info['state'] == 'failed':
-                    raise Exception("Video processing failed")
-                print("Video processing completed successfully")
-            
-            # Post tweet with media using v2 API
-            print("Creating tweet with media...")
-            tweet = twitter_client.create_tweet(
-                text=optimized_title,
-                media_ids=[str(media.media_id)]
+
+    def next_queued(self):
+        """Return the first queued unused post whose media can still be tweeted, or None.
+
+        Posts whose media ids are about to expire leave the queue and go
+        back to normal selection; posts a publish has already taken are
+        skipped.
+        """
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE posts SET media_ids = NULL, media_expires = NULL, queued_at = NULL "
+                "WHERE used = 0 AND queued_at IS NOT NULL AND media_expires < ?",
+                (time.time() + MEDIA_ID_MARGIN,)
             )
-            
-            print(f"Tweet posted successfully with ID: {tweet.data['id']}")
-            
-            # Mark post as used and save
-            post.used = True
-            save_posts(posts)
-            
-            # Clean up media files
-            try:
-                # Clean up original file
-                os.remove(post.media_path)
-                print(f"Cleaned up original media file: {post.media_path}")
-                
-                # Clean up processed file if it exists
-                if is_video and upload_path != post.media_path:
-                    os.remove(upload_path)
-                    print(f"Cleaned up processed media file: {upload_path}")
-                    
-            except Exception as e:
-                print(f"Error cleaning up media files: {e}")
-                
-        except Exception as e:
-            print(f"Error posting to Twitter: {str(e)}")
-            if "media" in str(e).lower():
-                print("Media upload failed, marking post as used to skip")
-                post.used = True
-                save_posts(posts)
-                
-    except Exception as e:
-        print(f"Error in post_to_twitter: {str(e)}")
+            row = self.conn.execute("""
+                SELECT * FROM posts WHERE used = 0 AND queued_at IS NOT NULL
+                    AND id NOT IN (SELECT post_id FROM publish_journal WHERE state IN ('selected', 'uploaded', 'tweeting'))
+                ORDER BY queued_at LIMIT 1""").fetchone()
+        return self._to_post(row) if row else None
 
-def clean_media_directory():
-    """Delete all files in the media directory."""
-    for media_file in MEDIA_DIR.glob('*'):
-        try:
-            media_file.unlink()
-            print(f"Deleted media file: {media_file}")
-        except Exception as e:
-            print(f"Error deleting media file {media_file}: {e}")
+    def count_queued(self):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM posts WHERE used = 0 AND queued_at IS NOT NULL AND media_expires >= ?",
+                (time.time() + MEDIA_ID_MARGIN,)
+            ).fetchone()[0]
 
-def main():
+    def count_fresh(self, since):
+        """Count unused posts created at or after the timestamp `since`."""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM posts WHERE used = 0 AND created_utc >= ?", (since,)
+            ).fetchone()[0]
 
-    clean_media_directory()
+    def mark_used(self, post_id):
+        """Flag a post as used, dropping its publish if one is still open."""
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE posts SET used = 1 WHERE id = ?", (post_id,))
+            self.conn.execute(
+                "UPDATE publish_journal SET state = 'dropped', updated_utc = ? WHERE post_id = ? AND state != 'tweeted'",
+                (time.time(), post_id)
+            )
 
-    # Fetch new posts at the start of each day
-    schedule.every().day.at("00:00").do(fetch_new_posts)
-    
-    
-    # post twice a day
-    schedule.every().day.at("09:00").do(post_to_twitter)  # First post at 9:00 AM
-    schedule.every().day.at("17:00").do(post_to_twitter)  # Second post at 5:00 PM
-    
-    # Initial fetch
-    fetch_new_posts()
-    
-    while True:
-        schedule.run_pending()
-        time.sleep(60)
+    def claim_publish(self, post_id, owner, media_ids=None, expires=None):
+        """Open a publish of an unused post for `owner`; False if another publish already holds it.
+
+        The check and the claim are one conditional write, so publishes
+        running at once (threads or processes) never take the same post.
+        """
+        with self.lock, self.conn:
+            cursor = self.conn.execute("""
+                INSERT INTO publish_journal (post_id, state, media_ids, media_expires, updated_utc, claimed_by, claimed_at)
+                SELECT ?, ?, ?, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM posts WHERE id = ? AND used = 0)
+                ON CONFLICT(post_id) DO UPDATE SET state = excluded.state, media_ids = excluded.media_ids,
+                    media_expires = excluded.media_expires, updated_utc = excluded.updated_utc,
+                    claimed_by = excluded.claimed_by, claimed_at = excluded.claimed_at
+                WHERE publish_journal.state NOT IN ('selected', 'uploaded', 'tweeting')""",
+                (post_id, 'uploaded' if media_ids else 'selected', json.dumps(media_ids) if media_ids else None,
+                 expires, time.time(), owner, time.time(), post_id)
+            )
+        return cursor.rowcount == 1
+
+    def renew_publish(self, post_id, owner):
+        """Extend the lease of a publish `owner` still holds."""
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE publish_journal SET claimed_at = ? WHERE post_id = ? AND claimed_by = ?",
+                (time.time(), post_id, owner)
+            )
+
+    def release_publish(self, post_id, owner):
+        """Let go of a publish `owner` holds; an entry left open is resumed by the next publish."""
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE publish_journal SET claimed_by = NULL, claimed_at = NULL WHERE post_id = ? AND claimed_by = ?",
+                (post_id, owner)
+            )
+
+    def journal_publish(self, post_id, state, media_ids=None, expires=None):
+        """Durably move a publish to `state` ('selected', 'uploaded' or 'tweeting') before acting on it."""
+        with self.lock, self.conn:
+            self.conn.execute("""
+                INSERT INTO publish_journal (post_id, state, media_ids, media_expires, updated_utc)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(post_id) DO UPDATE SET state = excluded.state,
+                    media_ids = COALESCE(excluded.media_ids, media_ids),
+                    media_expires = COALESCE(excluded.media_expires, media_expires),
+                    updated_utc = excluded.updated_utc""",
+                (post_id, state, json.dumps(media_ids) if media_ids else None, expires, time.time())
+            )
+
+    def mark_tweeted(self, post_id, tweet_id):
+        """Close a publish: the tweet id and the used flag commit together."""
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE posts SET used = 1 WHERE id = ?", (post_id,))
+            self.conn.execute(
+                "UPDATE publish_journal SET state = 'tweeted', tweet_id = ?, updated_utc = ? WHERE post_id = ?",
+                (tweet_id, time.time(), post_id)
+            )
+
+    def publish_failed(self, post_id):
+        """Count a failed attempt and step the publish back to its last finished step; returns the attempts."""
+        with self.lock, self.conn:
+            self.conn.execute("""
+                UPDATE publish_journal SET attempts = attempts + 1, updated_utc = ?,
+                    state = CASE WHEN media_ids IS NULL THEN 'selected' ELSE 'uploaded' END
+                WHERE post_id = ?""", (time.time(), post_id)
+            )
+            row = self.conn.execute("SELECT attempts FROM publish_journal WHERE post_id = ?", (post_id,)).fetchone()
+        return row[0] if row else 0
+
+    def open_publish(self, owner):
+        """Claim the oldest unfinished publish for `owner` and return (post, state), or None.
+
+        A running publish renews its claim, in any process, so only entries
+        released or left unrenewed for PUBLISH_LEASE_SECONDS (their holder
+        died) are taken, with a conditional write so only one publish
+        resumes each. The post carries the journaled media ids while they
+        can still be tweeted, so a resumed publish does not upload again.
+        """
+        with self.lock, self.conn:
+            row = self.conn.execute("""
+                SELECT posts.*, publish_journal.state AS publish_state,
+                    publish_journal.claimed_by AS claimed_by, publish_journal.claimed_at AS claimed_at,
+                    publish_journal.media_ids AS journal_media_ids, publish_journal.media_expires AS journal_media_expires
+                FROM publish_journal JOIN posts ON posts.id = publish_journal.post_id
+                WHERE publish_journal.state IN ('selected', 'uploaded', 'tweeting') AND posts.used = 0
+                    AND (publish_journal.claimed_by IS NULL OR COALESCE(publish_journal.claimed_at, 0) < ?)
+                ORDER BY publish_journal.updated_utc LIMIT 1""", (time.time() - PUBLISH_LEASE_SECONDS,)).fetchone()
+            if row is None:
+                return None
+            cursor = self.conn.execute(
+                "UPDATE publish_journal SET claimed_by = ?, claimed_at = ? "
+                "WHERE post_id = ? AND claimed_by IS ? AND claimed_at IS ?",
+                (owner, time.time(), row['id'], row['claimed_by'], row['claimed_at'])
+            )
+            if cursor.rowcount != 1:
+                return None
+        post = self._to_post(row)
+        post.media_ids = post.media_expires = None
+        if row['journal_media_ids'] and row['journal_media_expires'] >= time.time() + MEDIA_ID_MARGIN:
+            post.media_ids = json.loads(row['journal_media_ids'])
+            post.media_expires = row['journal_media_expires']
+        return post, row['publish_state']
+
+    def count_open_publishes(self):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM publish_journal WHERE state IN ('selected', 'uploaded', 'tweeting')"
+            ).fetchone()[0]
+
+    def tweet_times(self, since):
+        """Return the epoch times of the tweets posted at or after the timestamp `since`."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT updated_utc FROM publish_journal WHERE state = 'tweeted' AND updated_utc >= ? ORDER BY updated_utc",
+                (since,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def count_published(self, since, until):
+        """Count publishes that finished (tweeted or dropped) between the timestamps `since` and `until`."""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM publish_journal WHERE state IN ('tweeted', 'dropped') "
+                "AND updated_utc >= ? AND updated_utc < ?", (since, until)
+            ).fetchone()[0]
+
+    def all_posts(self):
+        """Return every stored post, oldest insert first."""
+        with self.lock:
+            rows = self.conn.execute("SELECT * FROM posts ORDER BY rowid").fetchall()
+        return [self._to_post(row) for row in rows]
+
+    def seen_ids(self, post_ids):
+        """Return the subset of post_ids that were already stored or downloaded."""
+        post_ids = list(post_ids)
+        if not post_ids:
+            return set()
+        marks = ','.join('?' * len(post_ids))
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT id FROM seen WHERE id IN ({marks}) UNION SELECT id FROM posts WHERE id IN ({marks})",
+                post_ids + post_ids
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def seen_urls(self, urls):
+        """Return the subset of media urls already downloaded under any id (crossposts)."""
+        urls = list(urls)
+        if not urls:
+            return set()
+        marks = ','.join('?' * len(urls))
+        with self.lock:
+            rows = self.conn.execute(f"SELECT url FROM seen WHERE url IN ({marks})", urls).fetchall()
+        return {row[0] for row in rows}
+
+    def media_owner(self, post_id, media_hash):
+        """Return the id of an earlier post seen with the same media, or None."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT id FROM seen WHERE media_hash = ? AND id != ? LIMIT 1", (media_hash, post_id)
+            ).fetchone()
+        return row[0] if row else None
+
+    def mark_seen(self, post_id, url, media_hash=None):
+        """Record a post that was rejected on purpose, so later runs skip it without downloading."""
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO seen (id, url, media_hash, seen_utc) VALUES (?, ?, ?, ?)",
+                (post_id, url, media_hash, time.time())
+            )
+
+    def store_download(self, post, media_hash):
+        """Store a downloaded post and record it as seen with media_hash, unless its media is a repost.
+
+        Returns the id of an earlier post with the same media (the post is
+        then only marked seen), or None once it is stored. Check, seen row
+        and insert commit together, so a crash never leaves a post seen but
+        not stored, and concurrent downloads of a repost cannot both win.
+        """
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                "SELECT id FROM seen WHERE media_hash = ? AND id != ? LIMIT 1", (media_hash, post.id)
+            ).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO seen (id, url, media_hash, seen_utc) VALUES (?, ?, ?, ?)",
+                (post.id, post.url, media_hash, time.time())
+            )
+            if row is None:
+                self._insert_posts([post])
+        return row[0] if row else None
+
+    def count_unused(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM posts WHERE used = 0").fetchone()[0]
+
+    def unprepared_posts(self):
+        """Return unused posts that have no upload-ready file yet."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT * FROM posts WHERE used = 0 AND ready_path IS NULL ORDER BY rowid"
+            ).fetchall()
+        return [self._to_post(row) for row in rows]
+
+    def mark_ready(self, post_id, ready_path, ready_title=None):
+        """Record the upload-ready file (and optional title) of a post."""
+        with self.lock, self.conn:
+            # SET reads the old ready_path, so the bonus is added only once
+            self.conn.execute("""
+                UPDATE posts SET ready_path = ?, ready_title = ?,
+                    priority = priority + CASE WHEN ready_path IS NULL THEN ? ELSE 0 END
+                WHERE id = ?""",
+                (ready_path, ready_title, READY_BONUS_HOURS / FRESHNESS_HOURS, post_id)
+            )
+
+    def count_ready(self):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM posts WHERE used = 0 AND ready_path IS NOT NULL"
+            ).fetchone()[0]
+
+    def get_upload_session(self, path):
+        """Return the stored upload session of a file as a dict, or None."""
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM upload_sessions WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return None
+        return dict(row, acked=set(json.loads(row['acked'])))
+
+    def save_upload_session(self, path, size, mtime, media_id, expires, acked):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO upload_sessions (path, size, mtime, media_id, expires, acked) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (path, size, mtime, media_id, expires, json.dumps(sorted(acked)))
+            )
+
+    def delete_upload_session(self, path):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM upload_sessions WHERE path = ?", (path,))
+
+    def referenced_media(self):
+        """Return the media and ready files that unused posts still need."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT media_path, ready_path, media_paths FROM posts WHERE used = 0"
+            ).fetchall()
+        paths = set()
+        for media_path, ready_path, media_paths in rows:
+            paths.update(path for path in [media_path, ready_path] + json.loads(media_paths or '[]') if path)
+        return {os.path.abspath(path) for path in paths}
+
+    def stale_unused(self, before):
+        """Return unused posts created before the timestamp `before`, oldest first.
+
+        Queued posts and posts with a publish in progress are left out.
+        """
+        with self.lock:
+            rows = self.conn.execute("""
+                SELECT * FROM posts WHERE used = 0 AND created_utc < ? AND queued_at IS NULL
+                    AND id NOT IN (SELECT post_id FROM publish_journal WHERE state IN ('selected', 'uploaded', 'tweeting'))
+                ORDER BY created_utc""", (before,)
+            ).fetchall()
+        return [self._to_post(row) for row in rows]
+
+    def import_json(self, json_path):
+        """Import a posts_data.json list (the pre-SQLite format)."""
+        with open(json_path, 'r') as f:
+            data = json.load(f)
+        posts = [RedditPost(type('obj', (object,), post_data), from_json=True) for post_data in data]
+        self.add_posts(posts)
+        return len(posts)
+
+_post_stores = {}
+_post_stores_pid = None
+_post_store_lock = threading.Lock()
+
+def get_post_store(path=POSTS_DB):
+    """Open a post store once per process, importing a legacy posts_data.json into POSTS_DB.
+
+    A forked worker opens its own connections instead of the parent's.
+    """
+    global _post_stores_pid
+    with _post_store_lock:
+        if _post_stores_pid != os.getpid():
+            _inherited_connections.extend(_post_stores.values())
+            _post_stores.clear()
+            _post_stores_pid = os.getpid()
+        if path not in _post_stores:
+            store = PostStore(path)
+            if path == POSTS_DB and os.path.exists(POSTS_FILE):
+                count = store.import_json(POSTS_FILE)
+                os.replace(POSTS_FILE, f"{POSTS_FILE}.imported")
+                print(f"Imported {count} posts from {POSTS_FILE} into {POSTS_DB}")
+            _post_stores[path] = store
+        return _post_stores[path]
+
+class MediaCache:
+    """Content-addressed media files with an SQLite index, shared by every worker process.
+
+    Files live under MEDIA_CACHE_DIR named by their sha256, so a repost or a
+    second account's download is stored once. Keys map what a file was made
+    from to its blobs: 'raw:<source url>' for downloads (a gallery maps to
+    several blobs) and '<variant>:<source hash>' for transcodes.
+    """
+
+    def __init__(self, root=MEDIA_CACHE_DIR, max_bytes=MEDIA_CACHE_MB * 1024 * 1024):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(str(self.root / 'index.db'), check_same_thread=False, timeout=30)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS blobs (
+                    hash TEXT PRIMARY KEY,
+                    path TEXT,
+                    size INTEGER,
+                    last_used REAL
+                )""")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache_keys (
+                    key TEXT,
+                    position INTEGER,
+                    hash TEXT,
+                    PRIMARY KEY (key, position)
+                )""")
+            # Hit and miss counters per key kind, summed over every process and restart
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache_stats (
+                    kind TEXT PRIMARY KEY,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    misses INTEGER NOT NULL DEFAULT 0,
+                    bytes_saved INTEGER NOT NULL DEFAULT 0
+                )""")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS blobs_last_used ON blobs(last_used)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS cache_keys_hash ON cache_keys(hash)")
+
+    def _count(self, key, hits=0, misses=0, bytes_saved=0):
+        kind = key.split(':', 1)[0]
+        self.conn.execute("INSERT OR IGNORE INTO cache_stats (kind) VALUES (?)", (kind,))
+        self.conn.execute(
+            "UPDATE cache_stats SET hits = hits + ?, misses = misses + ?, bytes_saved = bytes_saved + ? WHERE kind = ?",
+            (hits, misses, bytes_saved, kind)
+        )
+
+    def get(self, key):
+        """Return the cached paths for key, or None unless every blob is still on disk."""
+        with self.lock:
+            rows = self.conn.execute("""
+                SELECT b.hash, b.path, b.size FROM cache_keys k JOIN blobs b ON b.hash = k.hash
+                WHERE k.key = ? ORDER BY k.position""", (key,)).fetchall()
+            if not rows or not all(os.path.exists(row['path']) for row in rows):
+                return None
+            with self.conn:
+                self.conn.executemany(
+                    "UPDATE blobs SET last_used = ? WHERE hash = ?",
+                    [(time.time(), row['hash']) for row in rows]
+                )
+                self._count(key, hits=1, bytes_saved=sum(row['size'] for row in rows))
+        return [row['path'] for row in rows]
+
+    def put(self, key, paths):
+        """Move freshly made files into the cache under key and return their cached paths."""
+        entries = []
+        for path in paths:
+            digest = hash_file(path)
+            blob_path = self.root / digest[:2] / f"{digest}{Path(path).suffix.lower()}"
+            blob_path.parent.mkdir(exist_ok=True)
+            if blob_path.exists():
+                os.remove(path)  # same content is already cached
+            else:
+                os.replace(path, blob_path)
+            entries.append((digest, str(blob_path), os.path.getsize(blob_path)))
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO blobs (hash, path, size, last_used) VALUES (?, ?, ?, ?)",
+                [(digest, path, size, now) for digest, path, size in entries]
+            )
+            self.conn.execute("DELETE FROM cache_keys WHERE key = ?", (key,))
+            self.conn.executemany(
+                "INSERT INTO cache_keys (key, position, hash) VALUES (?, ?, ?)",
+                [(key, position, digest) for position, (digest, _, _) in enumerate(entries)]
+            )
+            self._count(key, misses=1)
+        return [path for _, path, _ in entries]
+
+    def content_hash(self, path):
+        """sha256 of a file, free for cached files since it is their name."""
+        path = Path(path)
+        if path.parent.parent == self.root:
+            return path.stem
+        return hash_file(path)
+
+    def _drop(self, digests):
+        with self.conn:
+            self.conn.executemany("DELETE FROM blobs WHERE hash = ?", [(digest,) for digest in digests])
+            self.conn.executemany("DELETE FROM cache_keys WHERE hash = ?", [(digest,) for digest in digests])
+
+    def total_bytes(self):
+        with self.lock:
+            return self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+    def evict(self, keep=()):
+        """Delete least recently used blobs until the cache fits max_bytes.
+
+        Files in `keep` (media of unused posts) and blobs used in the last
+        MEDIA_CACHE_PIN_MINUTES, which may not be in the post pool yet, stay.
+        """
+        keep = {os.path.abspath(path) for path in keep}
+        pinned_after = time.time() - MEDIA_CACHE_PIN_MINUTES * 60
+        evicted = freed = 0
+        with self.lock:
+            total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+            if total <= self.max_bytes:
+                return 0
+            rows = self.conn.execute(
+                "SELECT hash, path, size FROM blobs WHERE last_used < ? ORDER BY last_used", (pinned_after,)
+            ).fetchall()
+            doomed = []
+            for row in rows:
+                if total - freed <= self.max_bytes:
+                    break
+                if os.path.abspath(row['path']) in keep:
+                    continue
+                try:
+                    os.remove(row['path'])
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    print(f"Error evicting cached media {row['path']}: {e}")
+                    continue
+                doomed.append(row['hash'])
+                freed += row['size']
+                evicted += 1
+            self._drop(doomed)
+        if evicted:
+            print(f"Media cache: evicted {evicted} files ({freed / (1024 * 1024):.1f}MB), "
+                  f"{(total - freed) / (1024 * 1024):.1f}MB of {self.max_bytes / (1024 * 1024):.0f}MB used")
+        return evicted
+
+    def verify(self, mode=MEDIA_CACHE_VERIFY):
+        """Startup integrity check: drop index rows whose file is missing or damaged, and stray files.
+
+        'size' compares file sizes with the index; 'hash' also re-hashes
+        every file, which reads the whole cache.
+        """
+        with self.lock:
+            rows = self.conn.execute("SELECT hash, path, size FROM blobs").fetchall()
+            bad = []
+            for row in rows:
+                path = row['path']
+                if not os.path.exists(path):
+                    bad.append(row['hash'])
+                elif os.path.getsize(path) != row['size'] or (mode == 'hash' and hash_file(path) != row['hash']):
+                    print(f"Media cache: {path} is damaged, removing it")
+                    os.remove(path)
+                    bad.append(row['hash'])
+            self._drop(bad)
+            indexed = {os.path.abspath(row['path']) for row in rows}
+        # Files no row points at, such as a move that finished after a crash
+        strays = 0
+        for path in self.root.glob('*/*'):
+            if path.is_file() and os.path.abspath(path) not in indexed:
+                path.unlink()
+                strays += 1
+        print(f"Media cache: {len(rows) - len(bad)} files verified ({mode}), "
+              f"{len(bad)} missing or damaged, {strays} stray files removed")
+        return len(bad)
+
+    def stats(self):
+        """Hits, misses, hit ratio and bytes saved per key kind, plus current size."""
+        with self.lock:
+            rows = self.conn.execute("SELECT kind, hits, misses, bytes_saved FROM cache_stats").fetchall()
+            size, files = self.conn.execute("SELECT COALESCE(SUM(size), 0), COUNT(*) FROM blobs").fetchone()
+        kinds = {}
+        for row in rows:
+            lookups = row['hits'] + row['misses']
+            kinds[row['kind']] = dict(row, hit_ratio=row['hits'] / lookups if lookups else 0.0)
+        return {'kinds': kinds, 'bytes': size, 'files': files}
+
+    def summary(self):
+        stats = self.stats()
+        parts = [
+            f"{kind} {values['hit_ratio']:.0%} hits ({values['hits']}/{values['hits'] + values['misses']}), "
+            f"{values['bytes_saved'] / (1024 * 1024):.1f}MB saved"
+            for kind, values in sorted(stats['kinds'].items())
+        ]
+        return (f"{stats['files']} files, {stats['bytes'] / (1024 * 1024):.1f}MB; "
+                + ('; '.join(parts) or 'no lookups yet'))
+
+_media_cache = None
+_media_cache_pid = None
+_media_cache_lock = threading.Lock()
+
+def get_media_cache():
+    """Open the media cache once per process (forked workers must not share a connection)."""
+    global _media_cache, _media_cache_pid
+    with _media_cache_lock:
+        if _media_cache is None or _media_cache_pid != os.getpid():
+            if _media_cache is not None:
+                _inherited_connections.append(_media_cache)
+            _media_cache = MediaCache()
+            _media_cache_pid = os.getpid()
+        return _media_cache
+
+class TokenBucket:
+    """Thread-safe token bucket: `capacity` tokens refilled evenly over `period` seconds."""
+
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        # Set when the server reported an exhausted window
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self):
+        with self.lock:
+            self._refill()
+            return self.tokens
+
+    def try_acquire(self, tokens=1):
+        """Take tokens if they are available right now."""
+        with self.lock:
+            self._refill()
+            if self.tokens < tokens or time.monotonic() < self.blocked_until:
+                return False
+            self.tokens -= tokens
+            return True
+
+    def acquire(self, timeout, tokens=1):
+        """Wait up to `timeout` seconds for tokens; False if they would come later."""
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.lock:
+                self._refill()
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                else:
+                    if self.tokens >= tokens:
+                        self.tokens -= tokens
+                        return True
+                    wait = (tokens - self.tokens) / self.rate
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def replay(self, spent):
+        """Set the tokens to what spending one at each epoch time in `spent` left of a bucket full a period ago.
+
+        A restarted process uses this to pick up the budget where the last
+        one left it, instead of starting full.
+        """
+        now = time.time()
+        tokens, last = float(self.capacity), now - self.capacity / self.rate
+        for moment in sorted(spent):
+            tokens = min(self.capacity, tokens + (moment - last) * self.rate) - 1
+            last = moment
+        with self.lock:
+            self.tokens = max(0.0, min(self.capacity, tokens + (now - last) * self.rate))
+            self.updated = time.monotonic()
+
+    def sync(self, remaining, reset_in=None):
+        """Trust the server's count: never plan more calls than it says are left.
+
+        `reset_in` is the number of seconds until the server's window resets;
+        with nothing remaining the bucket stays empty until then.
+        """
+        try:
+            remaining = float(remaining)
+        except (TypeError, ValueError):
+            return
+        try:
+            reset_in = max(0.0, float(reset_in)) if reset_in is not None else None
+        except (TypeError, ValueError):
+            reset_in = None
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, remaining)
+            if remaining < 1 and reset_in:
+                self.blocked_until = time.monotonic() + reset_in
+
+    def sync_headers(self, headers, prefix):
+        """Sync from `<prefix>-remaining` and the epoch `<prefix>-reset` headers (X style)."""
+        remaining = headers.get(f'{prefix}-remaining')
+        reset = headers.get(f'{prefix}-reset')
+        try:
+            reset_in = float(reset) - time.time() if reset is not None else None
+        except ValueError:
+            reset_in = None
+        self.sync(remaining, reset_in)
+
+API_BUDGETS = {}
+_api_budgets_lock = threading.Lock()
+
+def get_budget(name, capacity=None, period=60):
+    """The shared request budget for one API, created on first use."""
+    with _api_budgets_lock:
+        if name not in API_BUDGETS:
+            defaults = {
+                'reddit': (REDDIT_REQUESTS_PER_MINUTE, 60),
+                'reddit_public': (REDDIT_PUBLIC_REQUESTS_PER_MINUTE, 60),
+                'llm': (LLM_REQUESTS_PER_MINUTE, 60),
+            }
+            if capacity is None:
+                capacity, period = defaults[name]
+            API_BUDGETS[name] = TokenBucket(capacity, period)
+        return API_BUDGETS[name]
+
+def acquire_reddit_budget():
+    """Take a Reddit API token, first syncing with the limits PRAW last saw."""
+    limits = getattr(get_client('reddit').auth, 'limits', None) or {}
+    budget = get_budget('reddit')
+    if limits.get('remaining') is not None:
+        reset = limits.get('reset_timestamp')
+        budget.sync(limits['remaining'], reset - time.time() if reset else None)
+    return budget.acquire(BUDGET_WAIT)
+
+class Account:
+    """One pipeline: a set of subreddits publishing to one X account."""
+
+    def __init__(self, name, subreddits, env_prefix='', posts_db=None,
+                 publish_times=None, tweets_per_day=TWEETS_PER_DAY):
+        self.name = name
+        self.subreddits = list(subreddits)
+        # Credentials stay in the environment: <env_prefix>TWITTER_API_KEY and friends
+        self.env_prefix = env_prefix
+        self.posts_db = posts_db or (POSTS_DB if name == 'default' else f"posts_{name}.db")
+        self.publish_times = publish_times or PUBLISH_TIMES
+        self.tweet_budget = TokenBucket(tweets_per_day, 24 * 3600)
+        API_BUDGETS[f'x_tweets:{name}'] = self.tweet_budget
+
+    def credential(self, key):
+        return os.getenv(f"{self.env_prefix}{key}")
+
+    @property
+    def store(self):
+        return get_post_store(self.posts_db)
+
+    @property
+    def upload_budget(self):
+        return get_budget(f'x_upload:{self.name}', X_UPLOAD_REQUESTS_PER_15MIN, 15 * 60)
+
+    def oauth1(self):
+        """OAuth1 signer for the v1.1 media upload endpoint."""
+        from requests_oauthlib import OAuth1
+        return OAuth1(
+            self.credential('TWITTER_API_KEY'),
+            self.credential('TWITTER_API_SECRET'),
+            self.credential('TWITTER_ACCESS_TOKEN'),
+            self.credential('TWITTER_ACCESS_TOKEN_SECRET')
+        )
+
+_accounts = None
+_accounts_lock = threading.Lock()
+
+def load_accounts():
+    """Read the pipelines from ACCOUNTS_FILE, or the single default one built from SUBREDDITS."""
+    global _accounts
+    with _accounts_lock:
+        if _accounts is None:
+            if os.path.exists(ACCOUNTS_FILE):
+                with open(ACCOUNTS_FILE, 'r') as f:
+                    _accounts = [Account(**entry) for entry in json.load(f)]
+                print(f"Loaded {len(_accounts)} accounts from {ACCOUNTS_FILE}")
+            else:
+                _accounts = [Account('default', SUBREDDITS)]
+        return _accounts
+
+def get_default_account():
+    return load_accounts()[0]
+
+def media_in_use():
+    """Files that an unused post of any account still needs."""
+    keep = set()
+    for account in load_accounts():
+        keep |= account.store.referenced_media()
+    return keep
+
+def release_media(paths):
+    """Let go of media a post no longer needs.
+
+    Cached files stay for other accounts and reposts until the cache is
+    over its size cap; loose files from before the cache are deleted unless
+    another account still refers to them.
+    """
+    keep = media_in_use()
+    cache = get_media_cache()
+    for path in dict.fromkeys(paths):
+        if not path or os.path.abspath(path) in keep or not os.path.exists(path):
+            continue
+        if Path(path).parent.parent == cache.root:
+            continue
+        try:
+            os.remove(path)
+            print(f"Cleaned up media file: {path}")
+        except OSError as e:
+            print(f"Error cleaning up media file {path}: {e}")
+    trim_media_cache(cache, keep)
+
+def trim_media_cache(cache, keep):
+    """Evict the cache down to its cap, retiring stale posts when their media is what fills it.
+
+    Media of unused posts is never evicted, so a pool of old posts could
+    hold the cache over MEDIA_CACHE_MB forever. When eviction alone cannot
+    get under the cap, the oldest unused posts past STALE_AFTER_HOURS
+    (neither queued nor being published) are marked used until their cached
+    files cover the overshoot, and eviction runs again without them.
+    """
+    cache.evict(keep)
+    excess = cache.total_bytes() - cache.max_bytes
+    if excess <= 0:
+        return
+    before = time.time() - STALE_AFTER_HOURS * 3600
+    stale = sorted(
+        ((account.store, post) for account in load_accounts() for post in account.store.stale_unused(before)),
+        key=lambda entry: entry[1].created_utc
+    )
+    retired, freed = 0, []
+    for store, post in stale:
+        if excess <= 0:
+            break
+        store.mark_used(post.id)
+        retired += 1
+        paths = [path for path in (post.media_paths or [post.media_path]) + [post.ready_path] if path]
+        freed += paths
+        excess -= sum(
+            os.path.getsize(path) for path in set(paths)
+            if Path(path).parent.parent == cache.root and os.path.exists(path)
+        )
+    if not retired:
+        return
+    print(f"Media cache still over its cap: retired the {retired} oldest stale posts to free their media")
+    keep = media_in_use()
+    for path in dict.fromkeys(freed):
+        if os.path.abspath(path) in keep or Path(path).parent.parent == cache.root or not os.path.exists(path):
+            continue
+        try:
+            os.remove(path)
+        except OSError as e:
+            print(f"Error cleaning up media file {path}: {e}")
+    cache.evict(keep)
+
+def host_slot(url):
+    """Return the semaphore that bounds concurrent downloads from the url's host."""
+    host = urlparse(url).hostname or ''
+    with _host_semaphores_lock:
+        if host not in _host_semaphores:
+            _host_semaphores[host] = threading.BoundedSemaphore(PER_HOST_LIMIT)
+        return _host_semaphores[host]
+
+def list_subreddit(subreddit_name):
+    """List the candidate posts of a subreddit without downloading any media."""
+    candidates = []
+    if not acquire_reddit_budget():
+        print(f"r/{subreddit_name}: Reddit API budget exhausted, skipping this listing")
+        return candidates
+    try:
+        with stage('reddit_listing', subreddit=subreddit_name) as info:
+            subreddit = get_client('reddit').subreddit(subreddit_name)
+            # Get the top 5 posts for the week from the subreddit
+            for index ,post in enumerate(subreddit.top(limit=5, time_filter = 'week')):
+
+                print(f'r/{subreddit_name}: this is post number', index)
+
+                if not post.is_self and hasattr(post, 'url'):
+                    if subreddit_name.lower() == 'tiktokcringe' and not (post.is_video or 'v.redd.it' in post.url):
+                        print(f"Skipping non-video post in TikTokCringe: {post.title[:50]}")
+                        continue
+
+                    candidates.append(RedditPost(post))
+            info['posts'] = len(candidates)
+
+    except Exception as e:
+        print(f"Error fetching posts from {subreddit_name}: {str(e)}")
+    return candidates
+
+def count_title(key):
+    with _title_stats_lock:
+        TITLE_STATS[key] += 1
+
+def count_seen(key, amount=1):
+    with _seen_stats_lock:
+        SEEN_STATS[key] += amount
+
+def count_publish(key):
+    with _publish_stats_lock:
+        PUBLISH_STATS[key] += 1
+
+def count_media_check(result, reasons=()):
+    with _media_check_lock:
+        MEDIA_CHECK_STATS['checked'] += 1
+        MEDIA_CHECK_STATS[result] += 1
+        for reason in reasons:
+            counts = MEDIA_CHECK_REASONS[result]
+            counts[reason] = counts.get(reason, 0) + 1
+
+def hash_file(path):
+    """Return the sha256 hex digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def start_heartbeat(renew, interval, name):
+    """Call renew() every `interval` seconds in a daemon thread until the returned event is set."""
+    done = threading.Event()
+
+    def beat():
+        while not done.wait(interval):
+            try:
+                renew()
+            except Exception as e:
+                print(f"Heartbeat {name} failed: {e}")
+
+    threading.Thread(target=beat, name=name, daemon=True).start()
+    return done
+
+def shared_download(reddit_post):
+    """Download a post's media once for every account, worker process and restart.
+
+    Finished downloads go into the media cache under the post url, and a
+    <post_id>.lock file makes a concurrent worker wait for the first
+    download instead of fetching the same media again. The owner touches
+    the lock while it downloads, so only a lock left untouched for
+    SHARED_DOWNLOAD_WAIT (its worker crashed) is broken.
+    """
+    cache = get_media_cache()
+    key = f"raw:{reddit_post.url}"
+    lock_path = MEDIA_DIR / f"{reddit_post.id}.lock"
+    while True:
+        paths = cache.get(key)
+        if paths:
+            print(f"Reusing cached media of {reddit_post.id}")
+            return paths
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > SHARED_DOWNLOAD_WAIT:
+                    os.remove(lock_path)  # left behind by a crashed worker
+            except OSError:
+                pass
+            time.sleep(1)
+
+    done = start_heartbeat(functools.partial(os.utime, lock_path), SHARED_DOWNLOAD_WAIT / 10, f"lock-{reddit_post.id}")
+    try:
+        media = download_media(reddit_post.url, reddit_post.id, reddit_post.submission)
+        paths = (media if isinstance(media, list) else [media]) if media else []
+        return cache.put(key, paths) if paths else []
+    finally:
+        done.set()
+        with suppress(FileNotFoundError):
+            os.remove(lock_path)
+
+def download_post_media(reddit_post, store):
+    """Download the media of a single post, respecting the per-host limit, and store the post.
+
+    Media already stored under another Reddit id (a repost) is discarded,
+    and so is media X would reject (see check_post_media); both are
+    recorded as seen. A failed download is not, so the next run retries it.
+    Returns the stored media paths, or None.
+    """
+    print(f"\nProcessing post: {reddit_post.title[:50]}...")
+    print(f"URL: {reddit_post.url}")
+    with host_slot(reddit_post.url), stage('media_download', post_id=reddit_post.id) as info:
+        media_paths = shared_download(reddit_post)
+        info['bytes'] = sum(os.path.getsize(path) for path in media_paths if os.path.exists(path))
+        if not media_paths:
+            info['status'] = 'failed'
+    if not media_paths:
+        return None
+
+    media_hash = get_media_cache().content_hash(media_paths[0])
+    original_id = store.media_owner(reddit_post.id, media_hash)
+    if not original_id:
+        # Catch what X would reject now, instead of burning the post at upload time
+        usable = check_post_media(reddit_post.id, media_paths)
+        if not usable:
+            store.mark_seen(reddit_post.id, reddit_post.url, media_hash)
+            return None
+        reddit_post.media_path, reddit_post.media_paths = usable[0], usable
+        # Checked again as it is stored, in case a concurrent download of a repost got there first
+        original_id = store.store_download(reddit_post, media_hash)
+    if original_id:
+        count_seen('media_hits')
+        print(f"Post {reddit_post.id} reposts the media of {original_id}, skipping")
+        store.mark_seen(reddit_post.id, reddit_post.url, media_hash)
+        release_media(media_paths)
+        return None
+    count_seen('media_misses')
+    return usable
+
+def ingest_post(reddit_post, store):
+    """download_post_media for the ingest pool: a post that fails is reported, not raised into the whole run."""
+    try:
+        return download_post_media(reddit_post, store)
+    except Exception as e:
+        print(f"Error ingesting post {reddit_post.id}: {e}")
+        return None
+
+def fetch_new_posts(account=None):
+    """Fetch new posts from Reddit."""
+    account = account or get_default_account()
+    started = time.perf_counter()
+
+    # List every subreddit in parallel, keeping the order of the account's subreddits
+    with ThreadPoolExecutor(max_workers=INGEST_WORKERS) as pool:
+        listings = list(pool.map(list_subreddit, account.subreddits))
+    listed_posts = [post for listing in listings for post in listing]
+
+    # Skip posts seen in an earlier run before touching the network again
+    store = account.store
+    seen = store.seen_ids(post.id for post in listed_posts)
+    unseen_posts = [post for post in listed_posts if post.id not in seen]
+    seen_urls = store.seen_urls(post.url for post in unseen_posts)
+    candidates = [post for post in unseen_posts if post.url not in seen_urls]
+    count_seen('id_hits', len(seen))
+    count_seen('id_misses', len(unseen_posts))
+    count_seen('url_hits', len(unseen_posts) - len(candidates))
+    listed = time.perf_counter()
+
+    # Download media for many posts at once, storing each as it finishes; map() keeps the listing order
+    with ThreadPoolExecutor(max_workers=INGEST_WORKERS) as pool:
+        media_paths = list(pool.map(functools.partial(ingest_post, store=store), candidates))
+    finished = time.perf_counter()
+
+    posts = []
+    for reddit_post, paths in zip(candidates, media_paths):
+        if paths:
+            posts.append(reddit_post)
+            print(f"Successfully added {'video' if paths[0].endswith('.mp4') else 'image'} post from r/{reddit_post.subreddit}")
+        else:
+            print(f"No usable media, skipping post {reddit_post.id}")
+
+    print(f"\n[{account.name}] Fetched {len(posts)} new posts ({store.count_unused()} unused in pool)")
+    rss = peak_rss_mb()
+    print(f"Ingestion timings: listing {listed - started:.2f}s, "
+          f"download and save {finished - listed:.2f}s, "
+          f"total {finished - started:.2f}s, "
+          f"peak RSS {f'{rss:.0f}MB' if rss is not None else 'n/a'} "
+          f"({len(account.subreddits)} subreddits, {len(candidates)} candidates, {INGEST_WORKERS} workers)")
+    print(f"HTTP connections: {connection_stats()}")
+    print(f"Dedup: {len(listed_posts) - len(candidates)} already-seen posts skipped; totals since start: {SEEN_STATS}")
+    print(f"Media checks since start: {MEDIA_CHECK_STATS}, by reason: {MEDIA_CHECK_REASONS}")
+    print(f"Media cache: {get_media_cache().summary()}")
+
+# Twitter video requirements
+TWITTER_MAX_DURATION = 140  # seconds
+TWITTER_MAX_SIZE_MB = 512
+MAX_VIDEO_BITRATE = 2_000_000  # 2 Mbps is a good balance
+AUDIO_BITRATE = 128_000
+MAX_VIDEO_DIMENSION = 1280  # longer side of encoded video, larger inputs are downscaled
+
+# libx264 encode profiles: constant quality (CRF) capped at the planned bitrate.
+# threads 0 lets ffmpeg pick; `python dev.py bench-encode` compares them on this machine.
+ENCODE_PROFILES = {
+    'quality': {'preset': 'medium', 'crf': 21, 'threads': 0},
+    'balanced': {'preset': 'veryfast', 'crf': 23, 'threads': 0},
+    'fast': {'preset': 'superfast', 'crf': 24, 'threads': 0},
+    'small-cpu': {'preset': 'ultrafast', 'crf': 26, 'threads': 2},
+}
+ENCODE_PROFILE = os.getenv('ENCODE_PROFILE', 'balanced')
+ENCODE_THREADS = os.getenv('ENCODE_THREADS')  # overrides the profile's thread count
+# X upload limits for images and GIFs, checked from file headers at ingestion
+X_IMAGE_FORMATS = ('JPEG', 'PNG', 'WEBP', 'GIF')
+X_IMAGE_MAX_BYTES = 5 * 1024 * 1024
+X_IMAGE_MAX_DIMENSION = 8192
+X_IMAGE_MIN_DIMENSION = 4
+X_GIF_MAX_BYTES = 15 * 1024 * 1024
+X_GIF_MAX_FRAMES = 350
+X_GIF_MAX_SIZE = (1280, 1080)
+X_VIDEO_MIN_DURATION = 0.5  # seconds
+X_VIDEO_MIN_DIMENSION = 32
+X_VIDEO_MAX_ASPECT = 3.0  # 1:3 to 3:1
+FIXED_IMAGE_MAX_DIMENSION = 4096  # longer side of an image re-encoded to fit the limits
+# Cache key prefix for transcodes; settings are part of it so changing them re-encodes
+TRANSCODE_VARIANT = f"twitter-{TWITTER_MAX_DURATION}s-{MAX_VIDEO_BITRATE // 1000}k-{MAX_VIDEO_DIMENSION}-{ENCODE_PROFILE}"
+
+def probe_media(path):
+    """Read container and stream info with a single ffprobe call."""
+    command = [
+        'ffprobe', '-v', 'error',
+        '-show_format', '-show_streams',
+        '-of', 'json',
+        str(path)
+    ]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        print(f"FFprobe error: {result.stderr}")
+        return None
+    return json.loads(result.stdout)
+
+def plan_video_transcode(probe, size_bytes):
+    """Decide how to make a probed video Twitter-compatible in one ffmpeg pass.
+
+    Returns a dict with action 'copy' (remux only) or 'encode', the output
+    duration limit, the video bitrate cap, the downscaled (width, height) if
+    any and the reasons for the choice.
+    """
+    streams = probe.get('streams', [])
+    video = next((st for st in streams if st.get('codec_type') == 'video'), None)
+    audio = next((st for st in streams if st.get('codec_type') == 'audio'), None)
+    duration = float(probe.get('format', {}).get('duration') or (video or {}).get('duration') or 0)
+    container = probe.get('format', {}).get('format_name', '')
+
+    reasons = []
+    if video is None:
+        reasons.append('no video stream')
+    else:
+        if video.get('codec_name') != 'h264':
+            reasons.append(f"video codec {video.get('codec_name')}")
+        if video.get('pix_fmt') != 'yuv420p':
+            reasons.append(f"pix_fmt {video.get('pix_fmt')}")
+    scale = None
+    if video is not None and max(video.get('width') or 0, video.get('height') or 0) > MAX_VIDEO_DIMENSION:
+        width, height = video['width'], video['height']
+        factor = MAX_VIDEO_DIMENSION / max(width, height)
+        # libx264 needs even dimensions
+        scale = (max(2, int(width * factor) // 2 * 2), max(2, int(height * factor) // 2 * 2))
+        reasons.append(f"{width}x{height} over {MAX_VIDEO_DIMENSION}px")
+    if audio is not None and audio.get('codec_name') != 'aac':
+        reasons.append(f"audio codec {audio.get('codec_name')}")
+    if 'mp4' not in container and 'mov' not in container:
+        reasons.append(f"container {container}")
+
+    trim = duration > TWITTER_MAX_DURATION
+    out_duration = min(duration, TWITTER_MAX_DURATION) if duration else TWITTER_MAX_DURATION
+    max_bytes = TWITTER_MAX_SIZE_MB * 1024 * 1024
+    # Stream copy keeps the source bitrate, so only a trimmed share of the file has to fit
+    copy_bytes = size_bytes * (out_duration / duration) if duration else size_bytes
+    if copy_bytes > max_bytes:
+        reasons.append(f"{copy_bytes / (1024 * 1024):.0f}MB over the {TWITTER_MAX_SIZE_MB}MB cap")
+
+    # Spend at most 95% of the size cap, leaving room for audio and the container
+    budget = max_bytes * 8 * 0.95 / out_duration - (AUDIO_BITRATE if audio else 0)
+    video_bitrate = int(min(MAX_VIDEO_BITRATE, budget))
+
+    return {
+        'action': 'encode' if reasons else 'copy',
+        'duration': out_duration,
+        'trim': trim,
+        'video_bitrate': video_bitrate,
+        'scale': scale,
+        'has_audio': audio is not None,
+        'reasons': reasons or ['already Twitter-compatible']
+    }
+
+def encode_command(input_path, output_path, plan, profile=None):
+    """Build the ffmpeg command that carries out a transcode plan with an encode profile."""
+    profile = ENCODE_PROFILES[profile or ENCODE_PROFILE]
+    command = ['ffmpeg', '-y', '-i', input_path]
+    if plan['trim']:
+        command += ['-t', str(TWITTER_MAX_DURATION)]
+    if plan['action'] == 'copy':
+        command += ['-c', 'copy']
+    else:
+        bitrate = str(plan['video_bitrate'])
+        if plan['scale']:
+            command += ['-vf', 'scale={}:{}'.format(*plan['scale'])]
+        command += [
+            '-c:v', 'libx264',  # Video codec
+            '-preset', profile['preset'],
+            '-crf', str(profile['crf']),  # Constant quality...
+            '-maxrate', bitrate,  # ...capped so the size limit holds
+            '-bufsize', str(plan['video_bitrate'] * 2),
+            '-threads', str(ENCODE_THREADS or profile['threads']),
+            '-pix_fmt', 'yuv420p',  # Pixel format
+            '-c:a', 'aac',      # Audio codec
+            '-b:a', str(AUDIO_BITRATE)
+        ]
+    return command + ['-movflags', '+faststart', output_path]  # Enable fast start
+
+def twitter_violations(path):
+    """Reasons the file at path breaks Twitter's video limits; empty when it passes."""
+    probe = probe_media(path)
+    if probe is None:
+        return ['unreadable']
+    plan = plan_video_transcode(probe, os.path.getsize(path))
+    violations = [] if plan['action'] == 'copy' else list(plan['reasons'])
+    if plan['trim']:
+        violations.append(f"longer than {TWITTER_MAX_DURATION}s")
+    return violations
+
+def gif_frame_count(path, limit=X_GIF_MAX_FRAMES):
+    """Count a GIF's frames by walking its block structure, without decoding them.
+
+    Stops at limit + 1, which is enough to know the GIF is over the limit.
+    """
+    frames = 0
+    with open(path, 'rb') as f:
+        header = f.read(13)
+        if len(header) < 13 or header[:3] != b'GIF':
+            return 0
+        if header[10] & 0x80:
+            f.seek(3 * 2 ** ((header[10] & 0x07) + 1), os.SEEK_CUR)  # global color table
+
+        def skip_sub_blocks():
+            while True:
+                size = f.read(1)
+                if not size or size[0] == 0:
+                    return
+                f.seek(size[0], os.SEEK_CUR)
+
+        while frames <= limit:
+            block = f.read(1)
+            if not block or block == b'\x3b':  # trailer
+                break
+            if block == b'\x21':  # extension: label, then sub-blocks
+                f.read(1)
+                skip_sub_blocks()
+            elif block == b'\x2c':  # image descriptor
+                descriptor = f.read(9)
+                if len(descriptor) < 9:
+                    break
+                if descriptor[8] & 0x80:
+                    f.seek(3 * 2 ** ((descriptor[8] & 0x07) + 1), os.SEEK_CUR)  # local color table
+                f.read(1)  # LZW minimum code size
+                skip_sub_blocks()
+                frames += 1
+            else:
+                break
+    return frames
+
+def inspect_media(path):
+    """Check a downloaded file against X's upload limits, reading only its headers.
+
+    Returns (kind, problems) where kind is 'image', 'gif' or 'video' and
+    problems is a list of (reason, detail, fixable) tuples. Video problems
+    the transcode fixes and oversized still images are fixable; the rest
+    mean X would reject the file.
+    """
+    size = os.path.getsize(path)
+    problems = []
+    if path.endswith('.mp4'):
+        probe = probe_media(path)
+        if probe is None:
+            return 'video', [('unreadable', 'ffprobe failed', False)]
+        plan = plan_video_transcode(probe, size)
+        video = next((st for st in probe.get('streams', []) if st.get('codec_type') == 'video'), None)
+        duration = float(probe.get('format', {}).get('duration') or 0)
+        if video is None:
+            return 'video', [('no_video', 'no video stream', False)]
+        width, height = video.get('width') or 0, video.get('height') or 0
+        if duration and duration < X_VIDEO_MIN_DURATION:
+            problems.append(('duration', f"{duration:.2f}s is too short", False))
+        if min(width, height) < X_VIDEO_MIN_DIMENSION:
+            problems.append(('dimensions', f"{width}x{height} is too small", False))
+        elif max(width, height) / min(width, height) > X_VIDEO_MAX_ASPECT:
+            problems.append(('aspect_ratio', f"{width}x{height}", False))
+        if plan['trim']:
+            problems.append(('duration', f"{duration:.0f}s, trimmed to {TWITTER_MAX_DURATION}s", True))
+        if plan['action'] == 'encode':
+            problems.append(('codec', '; '.join(plan['reasons']), True))
+        return 'video', problems
+
+    from PIL import Image, UnidentifiedImageError
+    try:
+        # open() parses the header only; pixels are decoded on load()
+        with Image.open(path) as img:
+            image_format, (width, height) = img.format, img.size
+    except (UnidentifiedImageError, OSError) as e:
+        return 'image', [('unreadable', str(e), False)]
+
+    frames = gif_frame_count(path) if image_format == 'GIF' else 1
+    if frames > 1:
+        if size > X_GIF_MAX_BYTES:
+            problems.append(('bytes', f"GIF is {size / (1024 * 1024):.1f}MB", False))
+        if frames > X_GIF_MAX_FRAMES:
+            problems.append(('gif_frames', f"over {X_GIF_MAX_FRAMES} frames", False))
+        if width > X_GIF_MAX_SIZE[0] or height > X_GIF_MAX_SIZE[1]:
+            problems.append(('dimensions', f"GIF is {width}x{height}", False))
+        return 'gif', problems
+
+    if min(width, height) < X_IMAGE_MIN_DIMENSION:
+        problems.append(('dimensions', f"{width}x{height} is too small", False))
+    else:
+        if image_format not in X_IMAGE_FORMATS:
+            problems.append(('format', image_format, True))
+        if size > X_IMAGE_MAX_BYTES:
+            problems.append(('bytes', f"{size / (1024 * 1024):.1f}MB", True))
+        if max(width, height) > X_IMAGE_MAX_DIMENSION:
+            problems.append(('dimensions', f"{width}x{height}", True))
+    return 'image', problems
+
+def fit_image(path):
+    """Re-encode a still image as a JPEG within X's limits, through the media cache."""
+    from PIL import Image
+    cache = get_media_cache()
+    key = f"x-image:{cache.content_hash(path)}"
+    cached = cache.get(key)
+    if cached:
+        return cached[0]
+    temp_path = str(MEDIA_DIR / f"fitting_{os.getpid()}_{threading.get_ident()}.jpg")
+    try:
+        with Image.open(path) as img:
+            img = img.convert('RGB')
+            img.thumbnail((FIXED_IMAGE_MAX_DIMENSION, FIXED_IMAGE_MAX_DIMENSION))
+            for quality in (90, 80, 70, 60):
+                img.save(temp_path, 'JPEG', quality=quality, optimize=True)
+                if os.path.getsize(temp_path) <= X_IMAGE_MAX_BYTES:
+                    return cache.put(key, [temp_path])[0]
+        return None
+    finally:
+        # Moved into the cache on success; left over when too large or the image failed to decode
+        with suppress(FileNotFoundError):
+            os.remove(temp_path)
+
+def check_post_media(post_id, media_paths):
+    """Inspect a post's media at ingestion; fix what can be fixed now and drop the rest.
+
+    Returns the usable paths in order (empty when nothing is left). Videos
+    with fixable problems pass unchanged, since preparation transcodes them.
+    """
+    usable = []
+    for path in media_paths:
+        try:
+            kind, problems = inspect_media(path)
+        except Exception as e:
+            kind, problems = 'unknown', [('unreadable', str(e), False)]
+        reasons = [reason for reason, _, _ in problems]
+        details = '; '.join(f"{reason}: {detail}" for reason, detail, _ in problems)
+        if not problems:
+            count_media_check('passed')
+            usable.append(path)
+        elif not all(fixable for _, _, fixable in problems):
+            print(f"Rejecting {kind} of {post_id}: {details}")
+            count_media_check('rejected', reasons)
+        elif kind == 'image':
+            try:
+                fixed = fit_image(path)
+            except Exception as e:
+                # The header passed, but the full decode did not (a truncated or damaged file)
+                print(f"Rejecting image of {post_id}: unreadable ({e})")
+                count_media_check('rejected', ['unreadable'])
+                continue
+            if fixed:
+                print(f"Re-encoded image of {post_id} to fit X's limits ({details})")
+                count_media_check('fixed', reasons)
+                usable.append(fixed)
+            else:
+                print(f"Rejecting image of {post_id}: still too large after re-encoding ({details})")
+                count_media_check('rejected', reasons)
+        else:
+            count_media_check('fixed', reasons)
+            usable.append(path)
+    return usable
+
+def process_video_for_twitter(input_path):
+    """Process video to meet Twitter's requirements."""
+    try:
+        print("Processing video for Twitter compatibility...")
+        # Another account, worker or earlier run may already have transcoded the same content
+        cache = get_media_cache()
+        key = f"{TRANSCODE_VARIANT}:{cache.content_hash(input_path)}"
+        cached = cache.get(key)
+        if cached:
+            print(f"Reusing processed video: {cached[0]}")
+            return cached[0]
+        # ffmpeg writes a private file that is moved into the cache once complete
+        temp_path = str(MEDIA_DIR / f"processing_{os.getpid()}_{threading.get_ident()}_{os.path.basename(input_path)}")
+
+        probe = probe_media(input_path)
+        if probe is None:
+            return None
+        plan = plan_video_transcode(probe, os.path.getsize(input_path))
+        details = plan['reasons'] + [f"duration {plan['duration']:.1f}s"]
+        if plan['trim']:
+            details.append(f"trimmed to {TWITTER_MAX_DURATION}s")
+        if plan['action'] == 'encode':
+            details.append(f"profile {ENCODE_PROFILE}, max bitrate {plan['video_bitrate'] // 1000}k")
+        if plan['scale']:
+            details.append('scaled to {}x{}'.format(*plan['scale']))
+        print(f"Transcode plan for {input_path}: {plan['action']} ({'; '.join(details)})")
+
+        command = encode_command(input_path, temp_path, plan)
+
+        print("Running ffmpeg command...")
+        started = time.perf_counter()
+        with stage('transcode', path=input_path, action=plan['action'], profile=ENCODE_PROFILE) as info:
+            result = subprocess.run(command, capture_output=True, text=True)
+            if result.returncode == 0:
+                info['bytes'] = os.path.getsize(temp_path)
+            else:
+                info['status'] = 'failed'
+        elapsed = time.perf_counter() - started
+
+        if result.returncode != 0:
+            print(f"FFmpeg error: {result.stderr}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return None
+        output_path = cache.put(key, [temp_path])[0]
+
+        size_mb = os.path.getsize(output_path) / (1024 * 1024)
+        print(f"Video processed successfully ({plan['action']}) in {elapsed:.2f}s: {output_path} ({size_mb:.1f}MB)")
+        if size_mb > TWITTER_MAX_SIZE_MB:
+            print(f"Processed video too large ({size_mb:.1f}MB)")
+            return None
+        return output_path
+
+    except Exception as e:
+        print(f"Error processing video: {str(e)}")
+    return None
+
+class UploadError(Exception):
+    """A media upload request failed; the upload session is kept for a resume.
+
+    `permanent` is set when X rejected the media itself, so a retry cannot help.
+    """
+
+    def __init__(self, message, permanent=False):
+        super().__init__(message)
+        self.permanent = permanent
+
+class TweetError(Exception):
+    """X answered a tweet request with an error status, so nothing was posted."""
+
+    def __init__(self, status, text):
+        super().__init__(f"Tweet failed: {status} {text}")
+        self.status = status
+        # Invalid media or duplicate content; rate limits and outages are worth a retry
+        self.permanent = status in (400, 403)
+
+def upload_request(method, account, **kwargs):
+    """Call the v1.1 media upload endpoint and return its JSON body."""
+    kwargs.setdefault('timeout', HTTP_TIMEOUT)
+    command = (kwargs.get('data') or kwargs.get('params') or {}).get('command')
+    if not account.upload_budget.acquire(BUDGET_WAIT):
+        raise UploadError(f"{command} skipped: upload rate limit exhausted for {account.name}")
+    try:
+        response = get_http_session().request(method, TWITTER_UPLOAD_URL, auth=account.oauth1(), **kwargs)
+    except requests.RequestException as e:
+        raise UploadError(f"{command} request failed: {e}")
+    account.upload_budget.sync_headers(response.headers, 'x-rate-limit')
+    if response.status_code >= 400:
+        raise UploadError(f"{command} failed: {response.status_code} {response.text}", permanent=response.status_code == 400)
+    return response.json() if response.content else {}
+
+def chunked_upload(path, media_category, account):
+    """Upload a file with INIT/APPEND/FINALIZE, resuming a persisted session.
+
+    Chunks are appended UPLOAD_PARALLEL at a time and every acknowledged
+    chunk is recorded, so a failed upload restarts at the first missing
+    chunk instead of byte zero. Returns (media_id, processing_info, expires).
+    """
+    store = account.store
+    path = os.path.abspath(path)
+    size = os.path.getsize(path)
+    mtime = os.path.getmtime(path)
+    chunk_size = int(UPLOAD_CHUNK_MB * 1024 * 1024)
+
+    state = store.get_upload_session(path)
+    if state and (state['size'] != size or state['mtime'] != mtime or state['expires'] <= time.time()):
+        print(f"Discarding stale upload session {state['media_id']}")
+        state = None
+
+    if state:
+        media_id = state['media_id']
+        expires = state['expires']
+        acked = state['acked']
+        print(f"Resuming upload {media_id} with {len(acked)} chunks already acknowledged")
+    else:
+        init = upload_request('POST', account, data={
+            'command': 'INIT',
+            'total_bytes': size,
+            'media_type': mimetypes.guess_type(path)[0] or 'application/octet-stream',
+            'media_category': media_category
+        })
+        media_id = init['media_id_string']
+        expires = time.time() + init.get('expires_after_secs', 86400)
+        acked = set()
+        store.save_upload_session(path, size, mtime, media_id, expires, acked)
+        print(f"Started upload {media_id} ({size} bytes)")
+
+    acked_lock = threading.Lock()
+
+    def append(segment_index):
+        with open(path, 'rb') as f:
+            f.seek(segment_index * chunk_size)
+            chunk = f.read(chunk_size)
+        upload_request('POST', account, data={
+            'command': 'APPEND',
+            'media_id': media_id,
+            'segment_index': segment_index
+        }, files={'media': chunk})
+        with acked_lock:
+            acked.add(segment_index)
+            store.save_upload_session(path, size, mtime, media_id, expires, acked)
+
+    pending = [i for i in range(max(1, math.ceil(size / chunk_size))) if i not in acked]
+    with stage('upload', media_id=media_id, chunks=len(pending)) as info:
+        with ThreadPoolExecutor(max_workers=UPLOAD_PARALLEL) as pool:
+            list(pool.map(append, pending))
+        finalize = upload_request('POST', account, data={'command': 'FINALIZE', 'media_id': media_id})
+        info['bytes'] = min(size, len(pending) * chunk_size)
+    store.delete_upload_session(path)
+    print(f"Media uploaded with ID: {media_id}")
+    if 'expires_after_secs' in finalize:
+        expires = time.time() + finalize['expires_after_secs']
+    return media_id, finalize.get('processing_info'), expires
+
+def wait_for_processing(media_id, processing_info, account):
+    """Poll STATUS until X has finished processing an uploaded media."""
+    with stage('processing_wait', media_id=media_id):
+        while processing_info and processing_info.get('state') in ('pending', 'in_progress'):
+            wait_time = processing_info.get('check_after_secs', 5)
+            print(f"Media {media_id} still processing, waiting {wait_time} seconds...")
+            time.sleep(wait_time)
+            status = upload_request('GET', account, params={'command': 'STATUS', 'media_id': media_id})
+            processing_info = status.get('processing_info')
+
+    if processing_info and processing_info.get('state') == 'failed':
+        raise UploadError(f"Media processing failed: {processing_info.get('error')}", permanent=True)
+
+def prepare_media(media_path):
+    """Return (upload-ready path or None, stages timed) for media_path. Runs in a worker process.
+
+    The worker's METRICS are never exported, so its stages (the transcode)
+    go back to prepare_posts to be recorded in this process.
+    """
+    with captured_stages() as stages:
+        if not media_path or not os.path.exists(media_path):
+            print(f"Media file not found: {media_path}")
+            return None, stages
+        ready_path = process_video_for_twitter(media_path) if media_path.endswith('.mp4') else media_path
+    if not ready_path or not os.path.exists(ready_path) or os.path.getsize(ready_path) == 0:
+        return None, stages
+    return ready_path, stages
+
+def prepare_posts(account=None):
+    """Transcode and validate every unprepared post so publishing is upload plus tweet."""
+    account = account or get_default_account()
+    store = account.store
+    posts = store.unprepared_posts()
+    if not posts:
+        print("No posts waiting for preparation")
+        return
+
+    started = time.perf_counter()
+    prepared = 0
+    # Spawned, not forked: this process already runs threads whose locks a fork could copy while held
+    spawn = multiprocessing.get_context('spawn')
+    with ThreadPoolExecutor(max_workers=1) as title_pool, \
+            ProcessPoolExecutor(max_workers=PREPARE_WORKERS, mp_context=spawn) as pool:
+        # Titles for the whole batch are generated while the pool transcodes
+        titles_future = title_pool.submit(optimize_titles, [post.title for post in posts]) if PREGENERATE_TITLES else None
+        results = list(pool.map(prepare_media, [post.media_path for post in posts]))
+        ready_titles = titles_future.result() if titles_future else [None] * len(posts)
+    ready_paths = [ready_path for ready_path, _ in results]
+    for _, stages in results:
+        for record in stages:
+            record_stage(*record)
+
+    for post, ready_path, ready_title in zip(posts, ready_paths, ready_titles):
+        if not ready_path:
+            print(f"Preparation failed for {post.id}, dropping it from the pool")
+            store.mark_used(post.id)
+            continue
+        store.mark_ready(post.id, ready_path, ready_title)
+        prepared += 1
+
+    print(f"Prepared {prepared}/{len(posts)} posts in {time.perf_counter() - started:.2f}s "
+          f"with {PREPARE_WORKERS} workers ({store.count_ready()} ready to publish)")
+    print(f"Media cache: {get_media_cache().summary()}")
+
+def create_tweet(account, text, media_ids):
+    """Post a tweet through the v2 API and return its id.
+
+    The response's rate-limit headers are folded into the account's tweet
+    budget, so a limit the server reports is respected on the next run.
+    """
+    response = get_http_session().post(
+        f"{TWITTER_API_URL}/2/tweets",
+        json={'text': text, 'media': {'media_ids': [str(media_id) for media_id in media_ids]}},
+        auth=account.oauth1(),
+        timeout=HTTP_TIMEOUT
+    )
+    account.tweet_budget.sync_headers(response.headers, 'x-rate-limit')
+    account.tweet_budget.sync_headers(response.headers, 'x-user-limit-24hour')
+    if response.status_code >= 400:
+        raise TweetError(response.status_code, response.text)
+    return response.json()['data']['id']
+
+def upload_path_for(post, store):
+    """The file to upload for a post, transcoding now if preparation has not; None drops the post."""
+    # Check if media file still exists
+    if not os.path.exists(post.media_path):
+        print(f"Media file not found: {post.media_path}")
+        store.mark_used(post.id)
+        return None
+
+    # Prepared posts were transcoded ahead of time; otherwise process now
+    if post.ready_path and os.path.exists(post.ready_path):
+        return post.ready_path
+    if post.media_path.endswith('.mp4'):
+        print("Processing video before upload...")
+        processed_path = process_video_for_twitter(post.media_path)
+        if not processed_path:
+            print("Video processing failed")
+            store.mark_used(post.id)
+        return processed_path
+    return post.media_path
+
+def upload_post_media(post, upload_path, account):
+    """Upload a post's files in parallel and wait until X has processed them.
+
+    Returns (media_ids, expires), expires being when the first media id
+    can no longer be attached to a tweet.
+    """
+    # Upload media using v1.1 API
+    print(f"Uploading media file: {upload_path} ({os.path.getsize(upload_path)} bytes)")
+    # Animated GIFs have their own category (and frame/size limits checked at ingestion)
+    is_video = post.media_path.endswith('.mp4')
+    media_category = 'tweet_video' if is_video else 'tweet_gif' if upload_path.endswith('.gif') else 'tweet_image'
+
+    # Gallery posts attach their other images (up to MAX_TWEET_IMAGES) too
+    upload_paths = [upload_path] + [path for path in post.media_paths[1:MAX_TWEET_IMAGES] if os.path.exists(path)]
+
+    # Ensure that the app's permissions include "Read and Write"
+    with ThreadPoolExecutor(max_workers=len(upload_paths)) as pool:
+        uploads = list(pool.map(lambda path: chunked_upload(path, media_category, account), upload_paths))
+
+    # Wait for video processing if it's a video
+    for media_id, processing_info, _ in uploads:
+        if processing_info:
+            print("Waiting for media processing...")
+            wait_for_processing(media_id, processing_info, account)
+            print("Media processing completed successfully")
+    return [media_id for media_id, _, _ in uploads], min(expires for _, _, expires in uploads)
+
+def preupload_posts(account=None):
+    """Upload the media of the publishes due within PREUPLOAD_MINUTES, so each slot only tweets.
+
+    Posts are chosen by the normal selection and queued with their media
+    ids; publishes take queued posts first.
+    """
+    account = account or get_default_account()
+    store = account.store
+    now = datetime.now()
+    due = [slot for slot in plan_publish_slots(account, now) if slot <= now + timedelta(minutes=PREUPLOAD_MINUTES)]
+    missing = len(due) - store.count_queued()
+    uploaded = 0
+    for _ in range(max(0, missing)):
+        post = store.pick_unused()
+        if not post:
+            break
+        try:
+            upload_path = upload_path_for(post, store)
+            if not upload_path:
+                continue
+            media_ids, expires = upload_post_media(post, upload_path, account)
+            store.queue_post(post.id, media_ids, expires)
+            uploaded += 1
+        except UploadError as e:
+            if e.permanent:
+                print(f"X rejected the media of {post.id}, dropping it: {e}")
+                store.mark_used(post.id)
+                continue
+            # The session is stored; the publish (or the next pre-upload) resumes it
+            print(f"Pre-upload of {post.id} interrupted: {e}")
+            break
+        except Exception as e:
+            # Left in the pool; the publish retries it under the journal's attempt limit
+            print(f"Error pre-uploading {post.id}: {str(e)}")
+    print(f"[{account.name}] Pre-uploaded {uploaded} posts for {len(due)} publishes due "
+          f"in the next {PREUPLOAD_MINUTES} minutes ({store.count_queued()} queued)")
+
+def publish_owner():
+    """A claim token for one publish run."""
+    return f"{os.getpid()}/{os.urandom(6).hex()}"
+
+def post_to_twitter(account=None):
+    """Publish one post, finishing an interrupted publish first, then pre-uploaded posts.
+
+    Each step is journaled before the next one starts (selected, uploaded
+    with its media ids, tweeting, tweeted), so after a crash the publish
+    resumes from its last durable step and reuses media ids that can still
+    be tweeted. A publish that died with its tweet request in flight is
+    dropped, since X may already have posted it. Failures X reports as
+    final drop the post; others are retried up to PUBLISH_ATTEMPTS times.
+    Every publish claims its journal entry first and renews the claim
+    while it runs, so with PUBLISH_CONCURRENCY above 1, or a second worker
+    on the same database, no two runs take the same post.
+    """
+    account = account or get_default_account()
+    if account.tweet_budget.available() < 1:
+        print(f"[{account.name}] Daily tweet budget used up, skipping this publish")
+        return
+    store = account.store
+    owner = publish_owner()
+
+    post = None
+    while post is None:
+        resumed = store.open_publish(owner)
+        if resumed is None:
+            break
+        post, state = resumed
+        if state == 'tweeting':
+            print(f"Publish of {post.id} stopped with its tweet in flight; dropping it rather than risk a double post")
+            store.mark_used(post.id)
+            count_publish('interrupted')
+            post = None
+        else:
+            print(f"Resuming the interrupted publish of {post.id} from '{state}'")
+            count_publish('resumed')
+    while post is None:
+        post = store.next_queued() or store.pick_unused()
+        if not post:
+            print("No unused posts available")
+            return
+        if not store.claim_publish(post.id, owner, post.media_ids, post.media_expires):
+            post = None  # another publish took it first
+
+    lease = start_heartbeat(functools.partial(store.renew_publish, post.id, owner), PUBLISH_LEASE_SECONDS / 4,
+                            f"lease-{post.id}")
+    try:
+        # Use the pre-generated title when the preparation stage made one
+        optimized_title = post.ready_title or optimize_title(post.title)
+        
+        print(f"Posting to Twitter: {optimized_title}")
+        
+        upload_path = post.ready_path or post.media_path
+        if post.media_ids:
+            media_ids = post.media_ids
+            print(f"Using {len(media_ids)} media uploaded ahead of this slot")
+        else:
+            upload_path = upload_path_for(post, store)
+            if not upload_path:
+                return
+            media_ids, expires = upload_post_media(post, upload_path, account)
+            store.journal_publish(post.id, 'uploaded', media_ids, expires)
+        
+        # Post tweet with media using v2 API
+        print(f"Creating tweet with {len(media_ids)} media...")
+        account.tweet_budget.try_acquire()
+        store.journal_publish(post.id, 'tweeting')
+        with stage('tweet', post_id=post.id, account=account.name) as info:
+            try:
+                tweet_id = create_tweet(account, optimized_title, media_ids)
+            except (TweetError, requests.ConnectTimeout):
+                raise  # answered or never sent: nothing was posted
+            except requests.RequestException as e:
+                # The request may have reached X, so it must not be sent again
+                info['status'] = 'interrupted'
+                print(f"Tweet request for {post.id} failed in flight ({e}); dropping it rather than risk a double post")
+                store.mark_used(post.id)
+                count_publish('interrupted')
+                return
+        
+        print(f"Tweet posted successfully with ID: {tweet_id}")
+        store.mark_tweeted(post.id, tweet_id)
+        count_publish('tweeted')
+        
+        # Clean up original and processed files no other account still needs
+        release_media((post.media_paths or [post.media_path]) + [upload_path])
+            
+    except Exception as e:
+        if getattr(e, 'permanent', False):
+            print(f"X rejected post {post.id}, dropping it: {e}")
+            store.mark_used(post.id)
+            count_publish('dropped')
+            return
+        attempts = store.publish_failed(post.id)
+        if attempts >= PUBLISH_ATTEMPTS:
+            print(f"Publish of {post.id} failed {attempts} times, dropping it: {e}")
+            store.mark_used(post.id)
+            count_publish('dropped')
+        else:
+            # Upload sessions and media ids are kept, so the retry resumes where this one stopped
+            print(f"Publish of {post.id} failed (attempt {attempts}/{PUBLISH_ATTEMPTS}), will retry: {e}")
+            count_publish('retried')
+    finally:
+        lease.set()
+        store.release_publish(post.id, owner)
+
+def check_media_directory():
+    """Startup integrity check of media/ that keeps the cache across restarts.
+
+    The cache index is checked against its files, loose files left by a
+    crashed run (partial downloads, ffmpeg temp files, locks) are deleted
+    unless a post still refers to them, and the cache is trimmed to its cap.
+    """
+    keep = media_in_use()
+    cache = get_media_cache()
+    cache.verify()
+    for media_file in MEDIA_DIR.glob('*'):
+        if not media_file.is_file() or os.path.abspath(media_file) in keep:
+            continue
+        try:
+            media_file.unlink()
+            print(f"Deleted leftover media file: {media_file}")
+        except Exception as e:
+            print(f"Error deleting media file {media_file}: {e}")
+    trim_media_cache(cache, keep)
+    print(f"Media cache: {cache.summary()}")
+
+def next_slot(times, after):
+    """Earliest daily slot strictly after the datetime `after`."""
+    return min(
+        datetime.combine(after.date() + timedelta(days=days), slot)
+        for days in (0, 1) for slot in times
+        if datetime.combine(after.date() + timedelta(days=days), slot) > after
+    )
+
+def plan_publish_slots(account, now):
+    """Publish times from now until the next ingest, sized to the pool and the X quota.
+
+    Each of the account's publish times opens a PUBLISH_WINDOW_MINUTES window.
+    Every window gets a post while the pool has any, and fresh posts (younger
+    than STALE_AFTER_HOURS) ask for more, up to PUBLISH_BURST per window and
+    never more than the tweets the account's budget allows before the next
+    ingest. Slots sit evenly on a grid from each window's start. Publishes
+    already finished in a running window count against its share, so the
+    re-plan after every publish keeps the grid instead of squeezing the
+    same share into the time left; grid slots missed while the bot was
+    down are skipped, not caught up.
+    """
+    store = account.store
+    horizon = next_slot([datetime.strptime(t, '%H:%M').time() for t in INGEST_TIMES], now)
+    window = timedelta(minutes=PUBLISH_WINDOW_MINUTES)
+    starts = sorted(
+        datetime.combine(now.date() + timedelta(days=days), datetime.strptime(t, '%H:%M').time())
+        for days in (0, 1) for t in account.publish_times
+    )
+    starts = [start for start in starts if start + window > now and start < horizon]
+    unused = store.count_unused()
+    if not starts or not unused:
+        return []
+
+    # A publish belongs to the latest window that had opened when it finished
+    done = [
+        store.count_published(start.timestamp(), min(starts[index + 1:] + [now]).timestamp()) if start < now else 0
+        for index, start in enumerate(starts)
+    ]
+    published = sum(done)
+    # Sized as when the windows opened: published posts were in the pool and spent quota since
+    fresh = store.count_fresh(now.timestamp() - STALE_AFTER_HOURS * 3600) + published
+    budget = account.tweet_budget
+    quota = int(budget.available() + budget.rate * (horizon - now).total_seconds()) + published
+    wanted = max(min(len(starts), unused + published), min(fresh, len(starts) * PUBLISH_BURST))
+    total = min(wanted, quota)
+
+    slots = []
+    for index, start in enumerate(starts):
+        count = total // len(starts) + (1 if index < total % len(starts) else 0)
+        left = count - done[index]
+        if left <= 0:
+            continue
+        grid = [slot for slot in (start + window * i / count for i in range(count)) if slot >= now]
+        slots += grid[max(0, len(grid) - left):]
+    return sorted(slots)
+
+def shifted_slots(planner, minutes, now):
+    """A planner whose slots come `minutes` earlier (or later) than those of `planner`."""
+    return [slot + timedelta(minutes=minutes) for slot in planner(now)]
+
+class ScheduledJob:
+    def __init__(self, name, func, account, times=(), concurrency=1, run_at_start=False, then=None,
+                 planner=None):
+        """An account's job run at daily `times` (HH:MM), on trigger, or after the job named in `then`.
+
+        A `planner(now)` returning upcoming datetimes replaces fixed times; it
+        is asked again after every run and at least every PLAN_REFRESH_MINUTES.
+        """
+        self.name = name
+        self.planner = planner
+        self.func = func
+        self.account = account
+        self.times = [datetime.strptime(t, '%H:%M').time() for t in times]
+        self.concurrency = concurrency
+        self.run_at_start = run_at_start
+        self.then = then
+        self.semaphore = None
+
+def in_thread(func, name):
+    """Run func() in a new daemon thread; returns a future of its result for the running loop.
+
+    Daemon threads do not hold up interpreter exit, so a run still going
+    when shutdown gives up on it is abandoned instead of waited for.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def settle(result, error):
+        if not future.done():
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def run():
+        result, error = None, None
+        try:
+            result = func()
+        except Exception as e:
+            error = e
+        with suppress(RuntimeError):  # the loop closed after shutdown gave up on this run
+            loop.call_soon_threadsafe(settle, result, error)
+
+    threading.Thread(target=run, name=name, daemon=True).start()
+    return future
+
+class Scheduler:
+    """Asyncio scheduler: every job sleeps until its exact next slot and runs in a worker thread.
+
+    Jobs are independent tasks with their own concurrency limit, and each
+    run gets a thread of its own rather than a slot in a shared pool, so a
+    long ingestion never delays a publish. On shutdown no new runs start
+    and in-flight ones (uploads included) are given SHUTDOWN_TIMEOUT to
+    finish; any still running after that are abandoned.
+    """
+
+    def __init__(self):
+        self.jobs = {}
+        self.in_flight = set()
+        self.stopping = None
+
+    def add_job(self, job):
+        self.jobs[job.name] = job
+
+    def trigger(self, name, scheduled=None):
+        """Start a run of a job now; it waits for a free slot of the job's concurrency limit."""
+        task = asyncio.create_task(self._execute(self.jobs[name], scheduled or datetime.now()))
+        self.in_flight.add(task)
+        task.add_done_callback(self.in_flight.discard)
+
+    async def _execute(self, job, scheduled):
+        async with job.semaphore:
+            lag = (datetime.now() - scheduled).total_seconds()
+            SCHEDULER_STATS['job_lag_seconds'][job.name] = lag
+            SCHEDULER_STATS['in_flight'] = len(self.in_flight)
+            print(f"Running {job.name} (scheduled {scheduled:%Y-%m-%d %H:%M:%S}, lag {lag:.1f}s)")
+            try:
+                await in_thread(job.func, job.name)
+            except Exception as e:
+                print(f"Error in scheduled job {job.name}: {e}")
+            finally:
+                store = job.account.store
+                SCHEDULER_STATS['queue_depth'][job.account.name] = {
+                    'unused': store.count_unused(),
+                    'ready': store.count_ready(),
+                    'uploaded': store.count_queued(),
+                    'publishing': store.count_open_publishes()
+                }
+                print(f"Finished {job.name}; queue depth {SCHEDULER_STATS['queue_depth'][job.account.name]}")
+        if job.then and not self.stopping.is_set():
+            self.trigger(job.then)
+
+    async def _job_loop(self, job):
+        slot = datetime.now()
+        while True:
+            slot = next_slot(job.times, slot)
+            # Sleep until the exact slot; re-check in case the wait returned early
+            if await self._sleep_until(slot):
+                return
+            self.trigger(job.name, slot)
+
+    async def _planned_loop(self, job):
+        last = datetime.now()
+        while True:
+            now = datetime.now()
+            upcoming = [slot for slot in await in_thread(functools.partial(job.planner, now), f"{job.name}-plan")
+                        if slot > last]
+            SCHEDULER_STATS['planned_slots'][job.name] = len(upcoming)
+            refresh = now + timedelta(minutes=PLAN_REFRESH_MINUTES)
+            slot = min(upcoming) if upcoming else None
+            wake = slot if slot and slot <= refresh else refresh
+            if await self._sleep_until(wake):
+                return
+            if wake == slot:
+                self.trigger(job.name, slot)
+                last = slot
+
+    async def _sleep_until(self, moment):
+        """Sleep until `moment`; True if the scheduler is stopping instead."""
+        while (delay := (moment - datetime.now()).total_seconds()) > 0:
+            try:
+                await asyncio.wait_for(self.stopping.wait(), timeout=delay)
+                return True
+            except asyncio.TimeoutError:
+                pass
+        return False
+
+    async def run(self):
+        self.stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, self.stopping.set)
+            except (NotImplementedError, AttributeError, ValueError):
+                pass  # Windows: Ctrl+C still raises KeyboardInterrupt
+
+        for job in self.jobs.values():
+            job.semaphore = asyncio.Semaphore(job.concurrency)
+        loops = [asyncio.create_task(self._job_loop(job)) for job in self.jobs.values() if job.times]
+        loops += [asyncio.create_task(self._planned_loop(job)) for job in self.jobs.values() if job.planner]
+        for job in self.jobs.values():
+            if job.run_at_start:
+                self.trigger(job.name)
+
+        await self.stopping.wait()
+        print(f"Shutting down, waiting up to {SHUTDOWN_TIMEOUT}s for {len(self.in_flight)} in-flight jobs...")
+        for task in loops:
+            task.cancel()
+        if self.in_flight:
+            _, pending = await asyncio.wait(set(self.in_flight), timeout=SHUTDOWN_TIMEOUT)
+            if pending:
+                # Their journals and upload sessions let the next start resume them
+                print(f"Abandoning {len(pending)} jobs still running after {SHUTDOWN_TIMEOUT}s")
+        print("Scheduler stopped")
+
+def run_worker(shard_index=0, shard_count=1):
+    """Run the scheduler for one shard of the accounts."""
+    accounts = load_accounts()[shard_index::shard_count]
+    start_metrics_server(METRICS_PORT + shard_index if METRICS_PORT else 0)
+
+    scheduler = Scheduler()
+    for account in accounts:
+        prefix = '' if account.name == 'default' else f"{account.name}:"
+        # The tweet budget starts full; charge it with the last day's tweets so a restart cannot plan them again
+        account.tweet_budget.replay(account.store.tweet_times(time.time() - 24 * 3600))
+        # Fetch new posts at the start of each day (and once at startup), then prepare them
+        scheduler.add_job(ScheduledJob(f'{prefix}ingest', functools.partial(fetch_new_posts, account), account,
+                                       INGEST_TIMES, run_at_start=True, then=f'{prefix}prepare'))
+        scheduler.add_job(ScheduledJob(f'{prefix}prepare', functools.partial(prepare_posts, account), account,
+                                       then=f'{prefix}preupload'))
+        # Publish windows open at 9:00 AM and 5:00 PM unless the account sets its own times;
+        # the planner decides how many posts each window gets, and uploads run ahead of them
+        planner = functools.partial(plan_publish_slots, account)
+        scheduler.add_job(ScheduledJob(f'{prefix}preupload', functools.partial(preupload_posts, account), account,
+                                       planner=functools.partial(shifted_slots, planner, -PREUPLOAD_MINUTES)))
+        scheduler.add_job(ScheduledJob(f'{prefix}publish', functools.partial(post_to_twitter, account), account,
+                                       concurrency=PUBLISH_CONCURRENCY, planner=planner))
+    print(f"Worker {shard_index} running accounts: {', '.join(account.name for account in accounts)}")
+
+    asyncio.run(scheduler.run())
+
+def main():
+
+    verify_credentials()
+    check_media_directory()
+
+    # Shard the accounts across worker processes; they share media/ for downloads and transcodes
+    workers = min(ACCOUNT_WORKERS or os.cpu_count() or 1, len(load_accounts()))
+    if workers <= 1:
+        run_worker()
+        return
+
+    processes = [
+        multiprocessing.Process(target=run_worker, args=(index, workers), name=f"worker-{index}")
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()